@@ -0,0 +1,511 @@
+#coding:utf-8
+
+from covertree import CoverTree
+from node import Node
+import numpy as np
+import cPickle as pickle
+import json
+import os
+import inspect
+
+# arrays saved in a snapshot, values are saved separately
+SNAPSHOT_ARRAYS = ['indices', 'parents', 'dists', 'counts', 'same_ptr',
+'same_indices', 'level_ends', 'chd_keys', 'chd_cum']
+
+class CompactLevel:
+
+    def __init__(self, tree, level_i):
+        '''
+            init function of CompactLevel, a read-only view of one level of a
+            CompactCoverTree. Nodes are (point, level) tuples, and the points of
+            a level are the first level_ends[level_i] points of the tree
+
+            @tree: a CompactCoverTree
+            @level_i: position of the level in the level stack, 0 is root level
+        '''
+        self.tree = tree
+        self.level = tree.top_level - level_i
+        self.width = int(tree.level_ends[level_i])
+
+    def __len__(self):
+        return self.width
+
+    def __iter__(self):
+        for p in xrange(self.width):
+            yield (p, self.level)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.width
+        if i < 0 or i >= self.width:
+            raise IndexError('level index out of range')
+        return (i, self.level)
+
+class CompactCoverTree:
+
+    def __init__(self, dist_calculator, top_level, batch_dist_calculator=None):
+        '''
+            init function of CompactCoverTree, a read-only cover tree whose
+            levels are stored as parallel np.ndarray instead of Node objects.
+
+            Every distinct value is a point. Points are numbered level by level
+            from root, so the points of a level are a prefix of all points and
+            the points new to a level are a contiguous block, sorted by parent.
+            Self children are implicit: a point is on every level from the level
+            it is new to down to the bottom level
+
+            @dist_calculator: function to calculate distance
+            @top_level: level of root
+            @batch_dist_calculator: optional function to calculate distances between
+            one value and a stacked array of values
+        '''
+        if type(dist_calculator).__name__ != 'function':
+            raise Exception('dist_calculator is not a function!')
+        if batch_dist_calculator is not None and type(batch_dist_calculator).__name__ != 'function':
+            raise Exception('batch_dist_calculator is not a function!')
+
+        self.dist_calculator = dist_calculator
+        self.bounded_dist = 'upper_bound' in inspect.getargspec(dist_calculator)[0]
+        self.batch_dist_calculator = batch_dist_calculator
+        self.top_level = top_level
+        self.size = 0
+        # values of points, stacked in an np.ndarray if batch_dist_calculator is supplied
+        self.values = []
+        # per point arrays
+        self.indices = np.zeros(0, dtype=np.int64)
+        self.parents = np.zeros(0, dtype=np.int64)
+        self.dists = np.zeros(0, dtype=np.float64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.same_ptr = np.zeros(1, dtype=np.int64)
+        self.same_indices = np.zeros(0, dtype=np.int64)
+        # level_ends[i]: number of points on the i-th level of the level stack
+        self.level_ends = np.zeros(0, dtype=np.int64)
+        # children sorted by (parent, point) and prefix sums of their counts
+        self.chd_keys = np.zeros(0, dtype=np.int64)
+        self.chd_cum = np.zeros(1, dtype=np.int64)
+
+    @classmethod
+    def from_tree(cls, tree):
+        '''
+            convert a Node based cover tree to compact storage
+
+            @tree: a CoverTree
+
+            #return: a tree of class @cls
+        '''
+        if not isinstance(tree, CoverTree):
+            raise Exception('tree must be a CoverTree')
+
+        tree._roll_up_des_sum()
+        compact = cls(tree.dist_calculator, tree.top_level, tree.batch_dist_calculator)
+        compact.size = tree.size
+        point_of = {}
+        vals = []
+        indices = []
+        parents = []
+        dists = []
+        counts = []
+        same_sizes = []
+        same_indices = []
+        level_ends = []
+        for level_i, level in enumerate(tree.level_stack):
+            if 0 == level_i:
+                new_nodes = [tree.root_node]
+            else:
+                new_nodes = [ n for n in level if n.parent.self_chd is not n ]
+                new_nodes.sort(key=lambda n: point_of[id(n.parent.val)])
+            for n in new_nodes:
+                point_of[id(n.val)] = len(vals)
+                vals.append(n.val)
+                indices.append(n.index)
+                parents.append(-1 if 0 == level_i else point_of[id(n.parent.val)])
+                dists.append(0.0 if 0 == level_i else n.dist_to_prt)
+                counts.append(n.des_sum + len(n.same_val_set) + 1)
+                same_sizes.append(len(n.same_val_set))
+                same_indices.extend([ sn.index for sn in n.same_val_set ])
+            level_ends.append(len(vals))
+
+        compact.values = np.array(vals) if tree.batch_dist_calculator is not None else vals
+        compact.indices = np.array(indices, dtype=np.int64)
+        compact.parents = np.array(parents, dtype=np.int64)
+        compact.dists = np.array(dists, dtype=np.float64)
+        compact.counts = np.array(counts, dtype=np.int64)
+        compact.same_ptr = np.concatenate(([0], np.cumsum(same_sizes))).astype(np.int64)
+        compact.same_indices = np.array(same_indices, dtype=np.int64)
+        compact.level_ends = np.array(level_ends, dtype=np.int64)
+        compact._index_children()
+        return compact
+
+    @classmethod
+    def build(cls, values, dist_calculator, top_level, batch_dist_calculator=None, indices=None):
+        '''
+            bulk constructor, build a tree with CoverTree.build and convert it
+
+            @values: a list of values
+            @dist_calculator: function to calculate distance
+            @top_level: level of root node, None: the lowest level covering all values
+            @batch_dist_calculator: optional function to calculate distances between
+            one value and a stacked array of values
+            @indices: optional list of node indices, default: position in @values
+
+            #return: a tree of class @cls
+        '''
+        tree = CoverTree.build(values, dist_calculator, top_level, batch_dist_calculator, indices)
+        return cls.from_tree(tree)
+
+    def to_tree(self, cls=CoverTree):
+        '''
+            convert compact storage back to a Node based cover tree, nodes of
+            a level are in order of points. Same values share the value of
+            their point
+
+            @cls: class of the tree, CoverTree or its subclass
+
+            #return: a tree of class @cls
+        '''
+        tree = cls(self.dist_calculator, self.top_level, self.batch_dist_calculator)
+        if 0 == len(self.level_ends):
+            return tree
+
+        tree.size = self.size
+        # lowest node of every point so far
+        lowest = []
+        for level_i in xrange(len(self.level_ends)):
+            level = self.top_level - level_i
+            start = self._level_start(level)
+            end = int(self.level_ends[level_i])
+            new_nodes = []
+            for p in xrange(start, end):
+                index = int(self.indices[p])
+                same_val_set = [ Node(val=self.values[p], index=int(i)) for i in self._node_indices((p, level))[1:] ]
+                n = Node(val=self.values[p], level=level, same_val_set=same_val_set, index=index)
+                if 0 == level_i:
+                    n.parent = n
+                    tree.root_node = n
+                else:
+                    n.parent = lowest[self.parents[p]]
+                    n.dist_to_prt = float(self.dists[p])
+                    n.parent.children_set.append(n)
+                tree.index_nodes[index] = n
+                for sn in same_val_set:
+                    tree.index_nodes[sn.index] = n
+                new_nodes.append(n)
+
+            lowest = [ n.generate_chd(True) for n in lowest ] + new_nodes
+            tree.level_stack.append(list(lowest))
+
+        tree._count_descendants()
+        return tree
+
+    def save(self, path):
+        '''
+            save tree to a snapshot directory, every array is saved to a .npy
+            file. Stacked values are saved to values.npy, other values are
+            pickled to values.pkl
+
+            @path: directory of the snapshot, created if not exists
+        '''
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name in SNAPSHOT_ARRAYS:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+
+        stacked = isinstance(self.values, np.ndarray)
+        if stacked:
+            np.save(os.path.join(path, 'values.npy'), self.values)
+        else:
+            with open(os.path.join(path, 'values.pkl'), 'wb') as f:
+                pickle.dump(self.values, f, pickle.HIGHEST_PROTOCOL)
+
+        meta = {'top_level': self.top_level, 'size': self.size, 'stacked_values': stacked}
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, path, dist_calculator, batch_dist_calculator=None, mmap_mode='r'):
+        '''
+            open a snapshot saved by save, arrays and stacked values are memory
+            mapped so the tree is ready without reading them
+
+            @path: directory of the snapshot
+            @dist_calculator: function to calculate distance
+            @batch_dist_calculator: optional function to calculate distances between
+            one value and a stacked array of values, requires stacked values
+            @mmap_mode: mmap_mode of np.load, None: read arrays into memory
+
+            #return: a tree of class @cls
+        '''
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if batch_dist_calculator is not None and not meta['stacked_values']:
+            raise Exception('batch_dist_calculator requires stacked values')
+
+        tree = cls(dist_calculator, meta['top_level'], batch_dist_calculator)
+        tree.size = meta['size']
+        for name in SNAPSHOT_ARRAYS:
+            setattr(tree, name, np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode))
+        if meta['stacked_values']:
+            # rows of a np.memmap are np.memmap too, a plain np.ndarray view
+            # of the mapped file keeps dist calculators checking types working
+            tree.values = np.asarray(np.load(os.path.join(path, 'values.npy'), mmap_mode=mmap_mode))
+        else:
+            with open(os.path.join(path, 'values.pkl'), 'rb') as f:
+                tree.values = pickle.load(f)
+        return tree
+
+    def knn(self, value, k):
+        '''
+            find k nearest values of a value in tree
+
+            @value: value to query
+            @k: number of neighbours
+
+            #return: (indices, distances), at most @k of each, sorted by distance
+        '''
+        if k <= 0:
+            raise Exception('invalid k')
+        return self._search(value, k, None)
+
+    def range_query(self, value, radius):
+        '''
+            find values of tree within a radius of a value
+
+            @value: value to query
+            @radius: max distance
+
+            #return: (indices, distances), sorted by distance
+        '''
+        if radius < 0:
+            raise Exception('invalid radius')
+        return self._search(value, None, radius)
+
+    def _search(self, value, k, radius):
+        '''
+            search tree level by level from root, same as CoverTree._search.
+            Points stay on lower levels as their own self children, so only
+            distances to new children are calculated
+
+            @value: value to query
+            @k: number of neighbours, None for a range query
+            @radius: max distance of a range query
+
+            #return: (indices, distances) sorted by distance
+        '''
+        if 0 == len(self.level_ends):
+            return ([], [])
+
+        points = np.zeros(1, dtype=np.int64)
+        dists = self._value_dists(value, points)
+        for level_i in xrange(1, len(self.level_ends)):
+            new_points = self._new_children(points, self.top_level-level_i)
+            points = np.concatenate((points, new_points))
+            dists = np.concatenate((dists, self._value_dists(value, new_points)))
+
+            if k is None:
+                limit = radius
+            else:
+                order = np.argsort(dists, kind='mergesort')
+                amounts = np.cumsum(self._same_sizes(points[order]) + 1)
+                kth = np.searchsorted(amounts, k)
+                limit = np.inf if kth >= len(order) else dists[order[kth]]
+            keep = dists <= limit + np.power(2.0, self.top_level-level_i+1)
+            points = points[keep]
+            dists = dists[keep]
+
+        order = np.argsort(dists, kind='mergesort')
+        if k is None:
+            order = order[dists[order] <= radius]
+        indices = []
+        ret_dists = []
+        for i in order:
+            for index in self._node_indices((points[i], self.top_level)):
+                indices.append(index)
+                ret_dists.append(dists[i])
+        if k is not None:
+            return (indices[:k], ret_dists[:k])
+        return (indices, ret_dists)
+
+    def _value_dists(self, value, points, upper_bound=None):
+        '''
+            calculate distances between a value and an array of points
+
+            @value: a value
+            @points: np.ndarray of points
+            @upper_bound: optional, a distance above it may be returned as
+            any value above it
+
+            #return: np.ndarray of distances in order of @points
+        '''
+        if 0 == len(points):
+            return np.zeros(0)
+        if self.batch_dist_calculator is not None:
+            return self._calculate_val_dists(value, self.values[points])
+        return self._calculate_val_dists(value, [ self.values[p] for p in points ], upper_bound)
+
+    def _index_children(self):
+        '''
+            sort children by (parent, point) to find children of a point with
+            np.searchsorted, and sum up their counts
+        '''
+        n_points = len(self.parents)
+        chd = np.arange(1, n_points, dtype=np.int64)
+        self.chd_keys = self.parents[1:] * n_points + chd
+        order = np.argsort(self.chd_keys, kind='mergesort')
+        self.chd_keys = self.chd_keys[order]
+        self.chd_cum = np.concatenate(([0], np.cumsum(self.counts[chd[order]]))).astype(np.int64)
+
+    @property
+    def level_stack(self):
+        '''
+            levels from root to bottom, each level is a CompactLevel
+        '''
+        return [ CompactLevel(self, i) for i in xrange(len(self.level_ends)) ]
+
+    def _level_pos(self, level):
+        '''
+            position of a level in the level stack
+
+            @level: a level
+
+            #return: int
+        '''
+        return self.top_level - level
+
+    def _level_start(self, level):
+        '''
+            first point new to a level
+
+            @level: a level
+
+            #return: int
+        '''
+        level_i = self._level_pos(level)
+        return 0 if 0 == level_i else int(self.level_ends[level_i-1])
+
+    def _new_children(self, points, level):
+        '''
+            get children of points which are new to a level, self children excluded
+
+            @points: np.ndarray of points on level+1
+            @level: level of the children
+
+            #return: np.ndarray of points
+        '''
+        start = self._level_start(level)
+        end = int(self.level_ends[self._level_pos(level)])
+        block_parents = self.parents[start:end]
+        lo = np.searchsorted(block_parents, points, 'left')
+        hi = np.searchsorted(block_parents, points, 'right')
+        lens = hi - lo
+        total = np.sum(lens)
+        if 0 == total:
+            return np.zeros(0, dtype=np.int64)
+        # concatenate ranges [lo, hi) of every point
+        offsets = np.repeat(lo - (np.cumsum(lens) - lens), lens)
+        return start + offsets + np.arange(total)
+
+    def _counts_at(self, points, level):
+        '''
+            number of values in subtrees of points on a level, including the
+            points themselves and their same values
+
+            @points: np.ndarray of points
+            @level: level of the nodes
+
+            #return: np.ndarray of counts
+        '''
+        n_points = len(self.parents)
+        # children new to @level or higher levels belong to higher nodes of a point
+        end = int(self.level_ends[self._level_pos(level)])
+        lo = np.searchsorted(self.chd_keys, points * n_points, 'left')
+        hi = np.searchsorted(self.chd_keys, points * n_points + end, 'left')
+        return self.counts[points] - (self.chd_cum[hi] - self.chd_cum[lo])
+
+    def _split_children(self, node):
+        '''
+            get self child and other children of a node
+
+            @node: a (point, level) tuple
+
+            #return: (self child or None, a list of other children)
+        '''
+        point, level = node
+        if self._level_pos(level) == len(self.level_ends) - 1:
+            return (None, [])
+        chd = self._new_children(np.array([point], dtype=np.int64), level-1)
+        return ((point, level-1), [ (c, level-1) for c in chd ])
+
+    def _same_sizes(self, points):
+        '''
+            sizes of same value sets of points
+
+            @points: np.ndarray of points
+
+            #return: np.ndarray
+        '''
+        return self.same_ptr[points+1] - self.same_ptr[points]
+
+    def _point_dists(self, point, points, upper_bound=None):
+        '''
+            calculate distances between a point and an array of points
+
+            @point: a point
+            @points: np.ndarray of points
+            @upper_bound: optional, see _value_dists
+
+            #return: np.ndarray of distances in order of @points
+        '''
+        return self._value_dists(self.values[point], points, upper_bound)
+
+    def _stack_vals(self, node_set):
+        '''
+            collect values of a node set in the form _calculate_val_dists accepts
+
+            @node_set: a list of (point, level) tuples
+
+            #return: np.ndarray of stacked values if batch_dist_calculator is supplied, else a list
+        '''
+        points = np.array([ n[0] for n in node_set ], dtype=np.int64)
+        if self.batch_dist_calculator is not None:
+            return self.values[points]
+        return [ self.values[p] for p in points ]
+
+    def _calculate_val_dists(self, val, vals, upper_bound=None):
+        '''
+            calculate distances between a value and a collection of values
+
+            @val: the center value
+            @vals: values collected by _stack_vals
+            @upper_bound: optional, passed to a dist_calculator which takes it
+
+            #return: np.ndarray, distances in order of @vals
+        '''
+        if self.batch_dist_calculator is not None:
+            return self.batch_dist_calculator(val, vals)
+        d = self.dist_calculator
+        if upper_bound is not None and self.bounded_dist:
+            return np.array([d(v, val, upper_bound) for v in vals])
+        return np.array([d(v, val) for v in vals])
+
+    def _dist_to_set(self, node, node_set):
+        '''
+            calculate distances between a node and every node in a set
+
+            @node: a (point, level) tuple
+            @node_set: a list of (point, level) tuples
+
+            #return: np.ndarray, distances in order of @node_set
+        '''
+        points = np.array([ n[0] for n in node_set ], dtype=np.int64)
+        return self._point_dists(node[0], points)
+
+    def _node_indices(self, node):
+        '''
+            get indices of a node and nodes which share a same value with it
+
+            @node: a (point, level) tuple
+
+            #return: a list of indices
+        '''
+        p = node[0]
+        return [self.indices[p]] + self.same_indices[self.same_ptr[p]:self.same_ptr[p+1]].tolist()
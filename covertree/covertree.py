@@ -1,28 +1,190 @@
 #coding:utf-8
 
 from node import Node
+from dist_cache import DistCache
 import math
 from time import clock
 import numpy as np
+import inspect
 
 class CoverTree:
 
-    def __init__(self, dist_calculator, top_level):
+    def __init__(self, dist_calculator, top_level, batch_dist_calculator=None):
         '''
             init function of CoverTree
 
             @dist_calculator: function to calculate distance
-            @top_level: level of root node
+            @top_level: level of root node, None: fit the level of root to the data,
+            the root level grows whenever a node falls outside 2^top_level of root
+            @batch_dist_calculator: optional function to calculate distances between
+            one value and a stacked array of values, args=(val, vals), returns a
+            distance vector. Used instead of @dist_calculator whenever supplied.
+            When @dist_calculator takes an upper_bound argument, distances only
+            compared against a bound are calculated with it, see _filter
         '''
         if type(dist_calculator).__name__ != 'function':
             raise Exception('dist_calculator is not a function!')
-        
+        if batch_dist_calculator is not None and type(batch_dist_calculator).__name__ != 'function':
+            raise Exception('batch_dist_calculator is not a function!')
 
         self.dist_calculator = dist_calculator
+        self.bounded_dist = 'upper_bound' in inspect.getargspec(dist_calculator)[0]
+        self.batch_dist_calculator = batch_dist_calculator
         self.level_stack = []
-        self.top_level = top_level
+        # id of a level => (level, number of nodes at its head with an up to
+        # date level_pos), nodes are only appended to levels
+        self.level_indexed = {}
+        self.auto_top_level = top_level is None
+        self.top_level = 0 if top_level is None else top_level
         self.root_node = None
         self.size = 0
+        # index => a node on the self child chain of the value of index
+        self.index_nodes = {}
+        self.dist_cache = None
+        # descendants not yet added to des_sum, rolled up by _roll_up_des_sum
+        self.des_pending = {}
+        self.same_pending = {}
+        self.last_saved_dist_calls = 0
+        self.total_saved_dist_calls = 0
+
+    @classmethod
+    def build(cls, values, dist_calculator, top_level, batch_dist_calculator=None, indices=None):
+        '''
+            bulk constructor, build a tree from all values at once
+
+            @values: a list of values
+            @dist_calculator: function to calculate distance
+            @top_level: level of root node, None: the lowest level covering all values
+            @batch_dist_calculator: optional function to calculate distances between
+            one value and a stacked array of values
+            @indices: optional list of node indices, default: position in @values
+
+            #return: a tree of class @cls
+        '''
+        if indices is not None and len(indices) != len(values):
+            raise Exception('indices and values must share a common length')
+
+        tree = cls(dist_calculator, top_level, batch_dist_calculator)
+        nodes = []
+        for i, v in enumerate(values):
+            nodes.append(Node(val=v, index=i if indices is None else indices[i]))
+        tree._build(nodes)
+        return tree
+
+    def _build(self, nodes):
+        '''
+            batch construction of an empty tree, the first node becomes root and
+            the rest are partitioned level by level from top to bottom.
+            On level l every pending node keeps its cover set, the nodes of
+            level l+1 within 2^(l+2). A center of level l within 2^l of the node
+            has an ancestor of level j within 2^(j+1) of the node, so children of
+            the cover set are the only nodes of level l which may be within 2^l,
+            and the node either becomes a new center of level l (no child within
+            2^l), a duplicate of a child (distance 0) or goes on to level l-1
+            with the children within 2^(l+1) as its new cover set
+
+            @nodes: a list of nodes to build the tree from
+        '''
+        if self.root_node is not None:
+            raise Exception('bulk build requires an empty tree')
+        if 0 == len(nodes):
+            return
+
+        # values are stacked once, a node and its self children share a position
+        all_vals = self._stack_vals(nodes)
+        positions = {}
+        for i, n in enumerate(nodes):
+            positions[id(n.val)] = i
+
+        def dists_to(n, node_set):
+            if self.batch_dist_calculator is not None:
+                vals = all_vals[[positions[id(x.val)] for x in node_set]]
+            else:
+                vals = [x.val for x in node_set]
+            return self._calculate_val_dists(n.val, vals)
+
+        root = nodes[0]
+        dists = dists_to(root, nodes[1:])
+        if self.auto_top_level:
+            self.top_level = self._fit_level(np.max(dists) if 0 != len(dists) else 0.0)
+        root.level = self.top_level
+        root.parent = root
+        self.root_node = root
+        self.level_stack.append([root])
+        self.index_nodes[root.index] = root
+        self.size = 1
+
+        pending = []
+        for i, n in enumerate(nodes[1:]):
+            if dists[i] > np.power(2.0, self.top_level):
+                print 'insert false'
+                continue
+            self.size += 1
+            if 0.0 == dists[i]:
+                root.same_val_set.append(n)
+                self.index_nodes[n.index] = root
+            else:
+                pending.append((n, [root], dists[i:i+1]))
+
+        level = self.top_level
+        while 0 != len(pending):
+            level -= 1
+            bound = np.power(2.0, level)
+            self._push_level_stack()
+            new_level = self.level_stack[-1]
+            level_width = len(new_level)
+            next_pending = []
+
+            for n, cover_set, cover_dists in pending:
+                chd_set = []
+                for c in cover_set:
+                    chd_set.extend(c.children_set)
+                chd_dists = dists_to(n, chd_set)
+                nearest_i = np.argmin(chd_dists)
+                if 0.0 == chd_dists[nearest_i]:
+                    chd_set[nearest_i].same_val_set.append(n)
+                    self.index_nodes[n.index] = chd_set[nearest_i]
+                elif chd_dists[nearest_i] > bound:
+                    parent_i = np.argmin(cover_dists)
+                    parent_node = cover_set[parent_i]
+                    parent_node.children_set.append(n)
+                    n.parent = parent_node
+                    n.dist_to_prt = cover_dists[parent_i]
+                    n.level = level
+                    new_level.append(n)
+                    self.index_nodes[n.index] = n
+                else:
+                    next_pending.append((n, cover_set, [ len(c.children_set) for c in cover_set ], chd_set, chd_dists))
+
+            # new centers created after a node was visited are missing from its
+            # children set, add them before the set is filtered into a cover set
+            pending = []
+            for n, cover_set, chd_sizes, chd_set, chd_dists in next_pending:
+                missed = []
+                for i, c in enumerate(cover_set):
+                    missed.extend(c.children_set[chd_sizes[i]:])
+                if 0 != len(missed):
+                    chd_set = chd_set + missed
+                    chd_dists = np.concatenate((chd_dists, dists_to(n, missed)))
+                near = chd_dists <= 2*bound
+                pending.append((n, [ chd_set[i] for i in np.flatnonzero(near) ], chd_dists[near]))
+
+            # a level of self children only is useless at the bottom
+            if 0 == len(pending) and len(new_level) == level_width:
+                self._pop_level_stack()
+
+        self._count_descendants()
+
+    def _count_descendants(self):
+        '''
+            count descendants of all nodes from the bottom level up
+        '''
+        for level_nodes in reversed(self.level_stack):
+            for n in level_nodes:
+                total = 0
+                for chd in n.children_set:
+                    total += chd.des_sum + len(chd.same_val_set) + 1
+                n.des_sum = total - 1 - len(n.same_val_set) if 0 != len(n.children_set) else 0
 
     def insert(self, node):
         '''
@@ -33,12 +195,407 @@ class CoverTree:
             #return: True=>success; False=>fail;
         '''
 
-        set = self.level_stack[0] if 0 != len(self.level_stack) else []
-        if self._insert(node, set,  self.top_level):
+        self._open_dist_cache(node)
+        try:
+            if self.auto_top_level and self.root_node is not None:
+                self._fit_top_level(node)
+            set = self.level_stack[0] if 0 != len(self.level_stack) else []
+            inserted = self._insert(node, set,  self.top_level)
+        finally:
+            self._close_dist_cache()
+        if inserted:
             self.size += 1
         else:
             print 'insert false'
         
+    def merge(self, other):
+        '''
+            merge another tree into this tree, the other tree is consumed.
+            Nodes of @other are visited from root down. A node is grafted with
+            its whole subtree when no value of this tree is within 3*2^l of it,
+            since values under a node of level l are within 2^(l+1) of it, this
+            keeps separation on every level of the subtree. Otherwise its
+            children are visited, and its value is inserted after all grafts
+            since it is close to the subtrees of its children.
+            Grafts are found before any of them is attached, nodes of @other
+            are separated from each other already. They are attached from
+            the highest level down, so a graft finds its parent among grafts
+            of higher levels before it is promoted
+
+            @other: a CoverTree, levels of both trees are absolute
+        '''
+        if other.root_node is None:
+            return
+        if self.root_node is None:
+            self.__dict__.update(other.__dict__)
+            return
+        self._roll_up_des_sum()
+        other._roll_up_des_sum()
+
+        # root covers every value of other tree, and levels reach its bottom
+        bound = self._dist_to_set(other.root_node, [self.root_node])[0] + np.power(2.0, other.top_level+1)
+        while np.power(2.0, self.top_level) < bound:
+            self._grow_root()
+        other_bottom = other.top_level - len(other.level_stack) + 1
+        while self.top_level - len(self.level_stack) + 1 > other_bottom:
+            self._push_level_stack()
+
+        grafts = []
+        not_grafted = []
+        visiting = [other.root_node]
+        while 0 != len(visiting):
+            next_visiting = []
+            for n in visiting:
+                if not self._has_value_within(n.val, 3*np.power(2.0, n.level)):
+                    grafts.append(n)
+                    continue
+                not_grafted.append(n)
+                chain = n
+                while chain is not None:
+                    next_visiting.extend(other._split_children(chain)[1])
+                    chain = chain.self_chd
+            visiting = next_visiting
+
+        grafts.sort(key=lambda n: -n.level)
+        for n in grafts:
+            n.parent = None
+            self._graft(n)
+        for n in not_grafted:
+            self.insert(Node(val=n.val, index=n.index))
+            for sn in n.same_val_set:
+                self.insert(Node(val=sn.val, index=sn.index))
+
+    def _graft(self, node):
+        '''
+            attach a subtree of another tree, see merge
+
+            @node: root of the subtree
+        '''
+        self._reattach(node)
+        bottom_i = len(self.level_stack) - 1
+        subtree = [node]
+        while 0 != len(subtree):
+            n = subtree.pop()
+            self.level_stack[self.top_level-n.level].append(n)
+            subtree.extend(n.children_set)
+            # node may have been promoted as a self child by _reattach
+            if n is node or 0.0 != n.dist_to_prt:
+                self.index_nodes[n.index] = n
+                for sn in n.same_val_set:
+                    self.index_nodes[sn.index] = n
+                self.size += len(n.same_val_set) + 1
+            # self children reach down to bottom level of this tree
+            if 0 == len(n.children_set) and self.top_level-n.level < bottom_i:
+                self._expand_self_chd(n)
+
+    def remove(self, index):
+        '''
+            remove the value of an index from tree. Children of the removed
+            nodes are reattached under a node one level up, or promoted to
+            higher levels when no node covers them. Indices must be unique
+
+            @index: index of the value
+
+            #return: True=>success; False=>index not in tree;
+        '''
+        if not self.index_nodes.has_key(index):
+            return False
+        self._roll_up_des_sum()
+        top = self._chain_top(self.index_nodes.pop(index))
+        same_val_set = top.same_val_set
+
+        if top.index != index:
+            # only a same value is removed
+            for i, sn in enumerate(same_val_set):
+                if sn.index == index:
+                    del same_val_set[i]
+                    break
+            self._update_same_des_sum(top, -1)
+        elif 0 != len(same_val_set):
+            # a same value takes the place of the removed one
+            sn = same_val_set.pop(0)
+            n = top
+            while n is not None:
+                n.index = sn.index
+                n = n.self_chd
+            self.index_nodes[sn.index] = top
+            self._update_same_des_sum(top, -1)
+        else:
+            self._remove_chain(top)
+
+        self.size -= 1
+        return True
+
+    def update(self, index, new_value):
+        '''
+            replace the value of an index, the old value is removed and the
+            new value is inserted with the same index
+
+            @index: index of the value
+            @new_value: the new value
+
+            #return: True=>success; False=>index not in tree;
+        '''
+        if not self.remove(index):
+            return False
+        self.insert(Node(val=new_value, index=index))
+        return True
+
+    def _chain_top(self, node):
+        '''
+            get the highest node of the self child chain of a node
+
+            @node: a node in tree
+
+            #return: the node whose self children hold the same value
+        '''
+        while node is not self.root_node and 0.0 == node.dist_to_prt:
+            node = node.parent
+        return node
+
+    def _remove_chain(self, top):
+        '''
+            remove a node and its self children from tree, reattach their
+            other children from higher levels to lower levels
+
+            @top: highest node of the chain
+        '''
+        orphans = []
+        n = top
+        while n is not None:
+            self._remove_from_level(n)
+            for chd in n.children_set:
+                if chd is not n.self_chd:
+                    orphans.append(chd)
+            n = n.self_chd
+
+        if top is not self.root_node:
+            top.parent.remove_chd(top)
+            self._update_des_sum(top.parent, -(top.des_sum + 1))
+        elif 0 == len(orphans):
+            # the last value is removed
+            self.root_node = None
+            self.level_stack = []
+            self.level_indexed = {}
+            self.des_pending = {}
+            self.same_pending = {}
+            return
+        else:
+            # the highest orphan is promoted to root
+            root = orphans.pop(0)
+            while root.level < self.top_level:
+                root = self._promote(root)
+            root.parent = root
+            root.dist_to_prt = None
+            self.root_node = root
+
+        for n in orphans:
+            self._reattach(n)
+
+    def _remove_from_level(self, node):
+        '''
+            remove a node from its level in O(1) amortized, nodes appended
+            since the last removal are indexed now and the last node fills
+            the gap, order of nodes in a level is not kept
+
+            @node: a node in level stack
+        '''
+        level = self.level_stack[self.top_level-node.level]
+        indexed = self.level_indexed.get(id(level), (level, 0))[1]
+        for i in xrange(indexed, len(level)):
+            level[i].level_pos = i
+        last = level.pop()
+        if last is not node:
+            level[node.level_pos] = last
+            last.level_pos = node.level_pos
+        self.level_indexed[id(level)] = (level, len(level))
+
+    def _reattach(self, node):
+        '''
+            attach an orphan to the nearest node within 2^(l+1) on the level
+            above its level l. When no node is in range, node is promoted to
+            the level above, which it separates, and tries again.
+            Root grows when a node is promoted to level of root
+
+            @node: an orphan with its subtree
+        '''
+        while True:
+            level_i = self.top_level - node.level - 1
+            bound = np.power(2.0, node.level+1)
+            cover_set, dists = self._search_level(node.val, None, bound, level_i)
+            in_range = np.flatnonzero(dists <= bound)
+            if 0 != len(in_range):
+                nearest_i = in_range[np.argmin(dists[in_range])]
+                parent_node = cover_set[nearest_i]
+                parent_node.children_set.append(node)
+                node.parent = parent_node
+                node.dist_to_prt = dists[nearest_i]
+                self._update_des_sum(parent_node, node.des_sum + len(node.same_val_set) + 1)
+                return
+            if 0 == level_i:
+                self._grow_root()
+            node = self._promote(node)
+
+    def _promote(self, node):
+        '''
+            add a node to the level above its level, the node becomes its self child
+
+            @node: a node without parent
+
+            #return: the new node
+        '''
+        promoted = Node(val=node.val, des_sum=node.des_sum,
+        level=node.level+1, children_set=[node],
+        same_val_set=node.same_val_set, index=node.index)
+        promoted.self_chd = node
+        node.parent = promoted
+        node.dist_to_prt = 0.0
+        self.level_stack[self.top_level-promoted.level].append(promoted)
+        return promoted
+
+    def knn(self, value, k):
+        '''
+            find k nearest values of a value in tree
+
+            @value: value to query
+            @k: number of neighbours
+
+            #return: (indices, distances), at most @k of each, sorted by distance
+        '''
+        if k <= 0:
+            raise Exception('invalid k')
+        return self._search(value, k, None)
+
+    def range_query(self, value, radius):
+        '''
+            find values of tree within a radius of a value
+
+            @value: value to query
+            @radius: max distance
+
+            #return: (indices, distances), sorted by distance
+        '''
+        if radius < 0:
+            raise Exception('invalid radius')
+        return self._search(value, None, radius)
+
+    def _search(self, value, k, radius):
+        '''
+            search tree level by level from root. Values under a node of level l
+            are within 2^(l+1) of it, so a node is dropped when its distance
+            exceeds @radius, or the distance of the k-th nearest value found so
+            far, by 2^(l+1)
+
+            @value: value to query
+            @k: number of neighbours, None for a range query
+            @radius: max distance of a range query
+
+            #return: (indices, distances) sorted by distance
+        '''
+        if self.root_node is None:
+            return ([], [])
+
+        q_set, dists = self._search_level(value, k, radius, len(self.level_stack)-1)
+
+        indices = []
+        ret_dists = []
+        for i in np.argsort(dists, kind='mergesort'):
+            if k is None and dists[i] > radius:
+                break
+            for index in self._node_indices(q_set[i]):
+                indices.append(index)
+                ret_dists.append(dists[i])
+        if k is not None:
+            return (indices[:k], ret_dists[:k])
+        return (indices, ret_dists)
+
+    def _search_level(self, value, k, radius, stop_i):
+        '''
+            search tree from root down to a level, see _search
+
+            @value: value to query
+            @k: number of neighbours, None for a range query
+            @radius: max distance of a range query
+            @stop_i: position of the level to stop at in level stack
+
+            #return: (nodes, distances), nodes of the level which are not pruned
+        '''
+        q_set = [self.root_node]
+        dists = self._calculate_val_dists(value, self._stack_vals(q_set))
+        for level_i in xrange(1, stop_i+1):
+            chd_set, dists = self._search_children(value, q_set, dists)
+            limit = radius if k is None else self._kth_dist(chd_set, dists, k)
+            keep = np.flatnonzero(dists <= limit + np.power(2.0, self.top_level-level_i+1))
+            q_set = [ chd_set[i] for i in keep ]
+            dists = dists[keep]
+
+        return (q_set, dists)
+
+    def _has_value_within(self, value, radius):
+        '''
+            check if any value of tree is within a radius of a value, every
+            node holds a value so search stops at the first node in range
+
+            @value: value to query
+            @radius: max distance
+
+            #return: True or False
+        '''
+        if self.root_node is None:
+            return False
+        q_set = [self.root_node]
+        dists = self._calculate_val_dists(value, self._stack_vals(q_set))
+        for level_i in xrange(1, len(self.level_stack)):
+            if np.any(dists <= radius):
+                return True
+            chd_set, dists = self._search_children(value, q_set, dists)
+            keep = np.flatnonzero(dists <= radius + np.power(2.0, self.top_level-level_i+1))
+            if 0 == len(keep):
+                return False
+            q_set = [ chd_set[i] for i in keep ]
+            dists = dists[keep]
+        return np.any(dists <= radius)
+
+    def _search_children(self, value, q_set, dists):
+        '''
+            get children of nodes and their distances to a value
+
+            @value: value to query
+            @q_set: a list of nodes
+            @dists: np.ndarray of distances of @q_set
+
+            #return: (children, distances)
+        '''
+        chd_set = []
+        self_dists = []
+        new_chd_set = []
+        for i, n in enumerate(q_set):
+            self_chd, others = self._split_children(n)
+            # self child shares the distance of its parent
+            if self_chd is not None:
+                chd_set.append(self_chd)
+                self_dists.append(dists[i])
+            new_chd_set.extend(others)
+        chd_set.extend(new_chd_set)
+        if 0 != len(new_chd_set):
+            self_dists = np.concatenate((self_dists, self._calculate_val_dists(value, self._stack_vals(new_chd_set))))
+        return (chd_set, np.array(self_dists))
+
+    def _kth_dist(self, node_set, dists, k):
+        '''
+            distance of the k-th nearest value among nodes and their same values
+
+            @node_set: a list of nodes
+            @dists: np.ndarray of distances of @node_set
+            @k: k
+
+            #return: the distance, inf if there are less than @k values
+        '''
+        order = np.argsort(dists, kind='mergesort')
+        amounts = np.cumsum([ len(node_set[i].same_val_set) + 1 for i in order ])
+        kth = np.searchsorted(amounts, k)
+        return float('inf') if kth >= len(order) else dists[order[kth]]
+
     def _insert(self, node, cover_set, level):
         '''
             the real insert function
@@ -62,35 +619,29 @@ class CoverTree:
             node.level = level
             self.root_node.parent = node
             self.level_stack.append([node])
+            self.index_nodes[node.index] = node
             return True
 
-        #if level <= current max level, push a new level
-        is_new_level = level <= self.top_level-(len(self.level_stack)-1)
-        if is_new_level:
-            self._push_level_stack(node)
-
-        #get children set in 2^level range
+        #get children set in 2^level range, below bottom level children are
+        #temporary self children, levels are pushed only when node is inserted there
         chd_set = self._get_children_set(cover_set)
         dist_bound = np.power(2.0, level)
         valid_chd_set = self._filter(node, chd_set, 0.0, dist_bound)
 
         if 0 == len(valid_chd_set):
-            #if a new level, pop it
-            if is_new_level:
-                self._pop_level_stack()
             return False
         
         parent_info = self._distance_bew_node_set(node, cover_set)
         if 0.0==parent_info[0]:#already has this node
             parent_info[1].same_val_set.append(node)
-            # update desendants from  the first node which not the self parent to root node
-            p_to_update = parent_info[1]
-            while p_to_update.dist_to_prt==0.0:
-                p_to_update = p_to_update.parent
-            self._update_des_sum(p_to_update.parent)
-
-            if is_new_level:
-                self._pop_level_stack()
+            same_node = parent_info[1]
+            # a temporary self child below bottom level is not in tree
+            if same_node is not self.root_node and 0.0 == same_node.dist_to_prt and same_node.parent.self_chd is not same_node:
+                same_node = same_node.parent
+            self.index_nodes[node.index] = same_node
+            # desendants from the first node which not the self parent to root node
+            # are updated when pending counts are rolled up
+            self._update_same_des_sum(parent_info[1])
             return True
 
         if not self._insert(node, valid_chd_set, level-1):
@@ -98,22 +649,76 @@ class CoverTree:
             
             #if can not insert to this level(min distance less than 2^level)
             if parent_info[0] > dist_bound:
-                if is_new_level:
-                    self._pop_level_stack()
                 return False
             #can insert to this level
-            parent_node = parent_info[1]
+            while self.top_level-(len(self.level_stack)-1) > level-1:
+                self._push_level_stack()
+            parent_node = self._materialize(parent_info[1])
             parent_node.children_set.append(node)
             node.parent = parent_node
             node.dist_to_prt = parent_info[0]
             node.level = level-1
             self.level_stack[self.top_level-node.level].append(node)
+            self.index_nodes[node.index] = node
             self._update_des_sum(parent_node)
             self._expand_self_chd(node)
             return True
         else:
             return True
             
+    def _fit_level(self, dist):
+        '''
+            get the lowest level whose covering distance is not less than @dist
+
+            @dist: a distance
+
+            #return: int, the level l that 2^(l-1) < dist <= 2^l, 0 if dist is 0
+        '''
+        if 0.0 == dist:
+            return 0
+        level = int(math.ceil(math.log(dist, 2)))
+        # correct rounding errors of log
+        while np.power(2.0, level) < dist:
+            level += 1
+        while np.power(2.0, level-1) >= dist:
+            level -= 1
+        return level
+
+    def _fit_top_level(self, node):
+        '''
+            make sure a node is within 2^top_level of root before it is inserted.
+            While root is the only node, its level is set to the lowest level
+            covering @node, afterwards root grows upwards until @node is covered
+
+            @node: the node to be inserted
+        '''
+        dist = self._dist_to_set(node, [self.root_node])[0]
+        if 0.0 == dist:
+            return
+        if 1 == len(self.level_stack):
+            self.top_level = self._fit_level(dist)
+            self.root_node.level = self.top_level
+            return
+        while np.power(2.0, self.top_level) < dist:
+            self._grow_root()
+
+    def _grow_root(self):
+        '''
+            add a new level above root, the old root becomes self child of the new root
+        '''
+        old_root = self.root_node
+        new_root = Node(val=old_root.val, des_sum=old_root.des_sum,
+        level=old_root.level+1, children_set=[old_root],
+        same_val_set=old_root.same_val_set, index=old_root.index)
+        new_root.parent = new_root
+        new_root.self_chd = old_root
+        old_root.parent = new_root
+        old_root.dist_to_prt = 0.0
+
+        self.root_node = new_root
+        self.top_level += 1
+        self.level_stack.insert(0, [new_root])
+
     def _push_level_stack(self, no = None):
         '''
             add a new level to level stack
@@ -123,11 +728,24 @@ class CoverTree:
             new_level.append(n.generate_chd(True, no=no))
         self.level_stack.append(new_level)
         
+    def _materialize(self, node):
+        '''
+            get the node in tree that a node represents, a temporary self child
+            is replaced by the self child pushed to its level
+
+            @node: a node in tree or a temporary self child from _get_children_set
+
+            #return: the node in tree
+        '''
+        if node is self.root_node or node.dist_to_prt != 0.0 or node.parent.self_chd is node:
+            return node
+        return self._materialize(node.parent).self_chd
+
     def _pop_level_stack(self):
         '''
             pop a level from level stack
         '''
-        self.level_stack.pop()
+        self.level_indexed.pop(id(self.level_stack.pop()), None)
         for n in self.level_stack[-1]:
             n.remove_chd(n.self_chd)
 
@@ -164,32 +782,194 @@ class CoverTree:
         #check if set's class is list
         if type(node_set) != list:
             raise Exception('set not a list')
-        d = self.dist_calculator
+        dists = self._dist_to_set(center_node, node_set, high_bound)
         ret_list = []
-        for n in node_set:
-            if d(n.val, center_node.val)>=low_bound and d(n.val, center_node.val) <= high_bound:
+        for i, n in enumerate(node_set):
+            if dists[i]>=low_bound and dists[i] <= high_bound:
                 ret_list.append(n)
         return ret_list
 
+    def _split_children(self, node):
+        '''
+            get self child and other children of a node
+
+            @node: a node
+
+            #return: (self child or None, a list of other children)
+        '''
+        return (node.self_chd, [ chd for chd in node.children_set if chd is not node.self_chd ])
 
-    def _update_des_sum(self, node):
+    def _node_indices(self, node):
         '''
-            update sum of descendants from root to a node
+            get indices of a node and nodes which share a same value with it
+
+            @node: a node
+
+            #return: a list of indices
+        '''
+        return [node.index] + [ sn.index for sn in node.same_val_set ]
+
+    def _open_dist_cache(self, node):
+        '''
+            open a distance cache for the distances between @node and other
+            nodes, which lasts until _close_dist_cache is called
+
+            @node: the query node
+
+            #return: True=>a new cache opened; False=>a cache has been opened
+        '''
+        if self.dist_cache is not None:
+            return False
+        self.dist_cache = DistCache(node)
+        return True
+
+    def _close_dist_cache(self):
+        '''
+            close the distance cache and count distance calls it saved
+
+            #return: number of distance calls saved by the closed cache
+        '''
+        saved = self.dist_cache.saved
+        self.dist_cache = None
+        self.last_saved_dist_calls = saved
+        self.total_saved_dist_calls += saved
+        return saved
+
+    def _dist_to_set(self, node, node_set, upper_bound=None):
+        '''
+            calculate distances between a node and every node in a set, using
+            batch_dist_calculator in a single call when it is supplied
+
+            @node: the center node
+            @node_set: a list of nodes
+            @upper_bound: optional, a distance above it may be returned as
+            any value above it
+
+            #return: np.ndarray, shape: [len(node_set)], distances in order of @node_set
+        '''
+        if 0 == len(node_set):
+            return np.array([])
+        # other calculators return exact distances, which are cached as they are
+        if not self.bounded_dist or self.batch_dist_calculator is not None:
+            upper_bound = None
+        if self.dist_cache is not None and self.dist_cache.is_for(node):
+            return np.array(self.dist_cache.lookup(node_set,
+            lambda s: self._calculate_dists(node, s, upper_bound), upper_bound))
+        return self._calculate_dists(node, node_set, upper_bound)
+
+    def _calculate_dists(self, node, node_set, upper_bound=None):
+        '''
+            calculate distances between a node and every node in a set without cache
+
+            @node: the center node
+            @node_set: a list of nodes
+            @upper_bound: optional, see _dist_to_set
+
+            #return: np.ndarray, shape: [len(node_set)], distances in order of @node_set
+        '''
+        return self._calculate_val_dists(node.val, self._stack_vals(node_set), upper_bound)
+
+    def _stack_vals(self, node_set):
+        '''
+            collect values of a node set in the form _calculate_val_dists accepts
+
+            @node_set: a list of nodes
+
+            #return: np.ndarray of stacked values if batch_dist_calculator is supplied, else a list
+        '''
+        if self.batch_dist_calculator is not None:
+            return np.array([n.val for n in node_set])
+        return [n.val for n in node_set]
+
+    def _calculate_val_dists(self, val, vals, upper_bound=None):
+        '''
+            calculate distances between a value and a collection of values
+
+            @val: the center value
+            @vals: values collected by _stack_vals
+            @upper_bound: optional, passed to a dist_calculator which takes it
+
+            #return: np.ndarray, shape: [len(vals)], distances in order of @vals
+        '''
+        if self.batch_dist_calculator is not None:
+            return self.batch_dist_calculator(val, vals)
+        d = self.dist_calculator
+        if upper_bound is not None and self.bounded_dist:
+            return np.array([d(v, val, upper_bound) for v in vals])
+        return np.array([d(v, val) for v in vals])
+
+
+    def _update_des_sum(self, node, count=1):
+        '''
+            count new children of a node, the sum of descendants of the node and
+            its ancestors is updated lazily by _roll_up_des_sum
             notice that sum  of descendants does not include a node itself
 
             @node: the node to update
+            @count: number of new descendants, negative for removed ones
         '''
         #check if node's class is Node
         if node.__class__ != Node:
             raise Exception('inserting a non-Node obj!')
 
-        p = node
-        while True:
-            p.des_sum += 1
-            if p == self.root_node:
-                break
-            else:
-                p = p.parent
+        self.des_pending[node] = self.des_pending.get(node, 0) + count
+
+    def _update_same_des_sum(self, node, count=1):
+        '''
+            count new values in same_val_set of a node, they are descendants of
+            ancestors above the self parents of the node, updated lazily by
+            _roll_up_des_sum
+
+            @node: the node whose same_val_set changes
+            @count: number of new values, negative for removed ones
+        '''
+        #check if node's class is Node
+        if node.__class__ != Node:
+            raise Exception('inserting a non-Node obj!')
+
+        self.same_pending[node] = self.same_pending.get(node, 0) + count
+
+    def _roll_up_des_sum(self):
+        '''
+            add pending counts to sum of descendants, nodes are visited from
+            the lowest level up so every node is updated once and passes its
+            counts on to its parent. Must be called before des_sum is read
+        '''
+        if 0 == len(self.des_pending) and 0 == len(self.same_pending):
+            return
+        des_pending = self.des_pending
+        same_pending = self.same_pending
+        self.des_pending = {}
+        self.same_pending = {}
+
+        levels = {}
+        for n in des_pending.keys() + same_pending.keys():
+            levels.setdefault(n.level, set()).add(n)
+
+        def add_pending(pending, n, count):
+            if n not in pending:
+                pending[n] = 0
+            pending[n] += count
+            levels.setdefault(n.level, set()).add(n)
+
+        level = min(levels)
+        while level <= self.top_level:
+            for n in levels.pop(level, []):
+                count = des_pending.pop(n, 0)
+                n.des_sum += count
+                same_count = same_pending.pop(n, 0)
+                # duplicates of root are counted by same_val_set only
+                if n is self.root_node:
+                    continue
+                if 0 != count:
+                    add_pending(des_pending, n.parent, count)
+                if 0 != same_count:
+                    # a self parent shares the same_val_set
+                    if 0.0 == n.dist_to_prt:
+                        add_pending(same_pending, n.parent, same_count)
+                    else:
+                        add_pending(des_pending, n.parent, same_count)
+            level += 1
 
     def _expand_self_chd(self, node):
         '''
@@ -229,12 +1009,9 @@ class CoverTree:
         if type(n_set) != list:
             raise Exception('set not a list')
 
-        min_dist = float('inf')
-        nearest_node = None
-        for n in n_set:
-            dist = self.dist_calculator(n.val, node.val)
-            if dist < min_dist:
-                min_dist = dist
-                nearest_node = n
+        if 0 == len(n_set):
+            return [float('inf'), None]
+        dists = self._dist_to_set(node, n_set)
+        nearest_i = np.argmin(dists)
         
-        return [min_dist, nearest_node]
+        return [dists[nearest_i], n_set[nearest_i]]
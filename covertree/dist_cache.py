@@ -0,0 +1,67 @@
+#coding:utf-8
+
+class DistCache:
+
+    def __init__(self, query):
+        '''
+            init function of DistCache, a cache of distances between one query
+            node and the candidate nodes met during one insert or one density
+            estimation. Keys are identities of node values, so a node and all
+            of its self children share a single entry
+
+            @query: the query node
+        '''
+        self.query = query
+        self.dists = {id(query.val): 0.0}
+        # distances known only to exceed a bound, kept as their lower bounds
+        self.lower_bounds = {}
+        self.saved = 0
+
+    def is_for(self, node):
+        '''
+            check if distances to @node can be served by this cache
+
+            @node: center node of a distance calculation
+
+            #return: True=>same query; False=>other node
+        '''
+        return node.val is self.query.val
+
+    def lookup(self, node_set, calculate, upper_bound=None):
+        '''
+            get distances between query and every node in a set, each missing
+            distance is calculated exactly once. With @upper_bound, a lower
+            bound above @upper_bound serves as well as the distance
+
+            @node_set: a list of nodes
+            @calculate: function to calculate distances of a list of nodes,
+            returns distances in order of the list, distances above
+            @upper_bound may be lower bounds above it
+            @upper_bound: optional, distances above it are not needed exactly
+
+            #return: a list of distances in order of @node_set
+        '''
+        dists = self.dists
+        lower_bounds = self.lower_bounds
+        keys = [ id(n.val) for n in node_set ]
+        found = []
+        for key in keys:
+            if key in dists:
+                found.append(dists[key])
+            elif upper_bound is not None and lower_bounds.get(key, upper_bound) > upper_bound:
+                found.append(lower_bounds[key])
+            else:
+                found.append(None)
+        missing = [ i for i, dist in enumerate(found) if dist is None ]
+        self.saved += len(keys) - len(missing)
+
+        if 0 != len(missing):
+            calculated = calculate([ node_set[i] for i in missing ])
+            for i, dist in zip(missing, calculated):
+                found[i] = dist
+                if upper_bound is not None and dist > upper_bound:
+                    lower_bounds[keys[i]] = dist
+                else:
+                    dists[keys[i]] = dist
+
+        return found
@@ -25,6 +25,12 @@ class Node:
         self.same_val_set = same_val_set if same_val_set is not None else []
         self.self_chd = None
         self.index = index
+        # position in children_set of parent, children at the head of a
+        # children_set, chd_indexed of them, have an up to date chd_pos
+        self.chd_pos = -1
+        self.chd_indexed = 0
+        # position in its level of level stack, see CoverTree._remove_from_level
+        self.level_pos = -1
     
     def generate_chd(self, add_self_chd=False, no=None):
         '''
@@ -36,7 +42,7 @@ class Node:
         '''
         chd = Node(val=self.val, parent=self, 
         dist_to_prt=0.0, 
-        des_sum=len(self.same_val_set),
+        des_sum=self.des_sum,
         level=self.level-1, children_set=[], 
         same_val_set=self.same_val_set, index=self.index)
 
@@ -52,11 +58,22 @@ class Node:
 
             @chd: chd node obj
         '''
-        if chd not in self.children_set:
+        # parent pointer tells membership, temporary self children are not in children_set
+        if chd.parent is not self or chd is self or (chd.dist_to_prt == 0.0 and chd is not self.self_chd):
             raise Exception('remove_son: not such child')
 
-        if chd == self.self_chd:
+        if chd is self.self_chd:
             self.self_chd = None
 
-        self.children_set.remove(chd)
+        # children are only appended, so those appended since the last
+        # removal are indexed now, and the last child fills the gap of the
+        # removed one: O(1) amortized, order of children is not kept
+        children_set = self.children_set
+        for i in xrange(self.chd_indexed, len(children_set)):
+            children_set[i].chd_pos = i
+        last = children_set.pop()
+        if last is not chd:
+            children_set[chd.chd_pos] = last
+            last.chd_pos = chd.chd_pos
+        self.chd_indexed = len(children_set)
 
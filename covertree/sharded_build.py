@@ -0,0 +1,130 @@
+#coding:utf-8
+
+from covertree import CoverTree
+from compact_covertree import CompactCoverTree, SNAPSHOT_ARRAYS
+from multiprocessing import Pool, cpu_count
+import numpy as np
+
+# (values, dist_calculator, top_level, batch_dist_calculator) shared with forked shard builders
+_shard_args = None
+
+def _build_shard(positions):
+    '''
+        build a tree of a shard in a worker process
+
+        @positions: positions of values of the shard
+
+        #return: (top_level, size, arrays of compact storage in order of SNAPSHOT_ARRAYS)
+    '''
+    values, dist_calculator, top_level, batch_dist_calculator = _shard_args
+    tree = CoverTree.build([ values[p] for p in positions ], dist_calculator, top_level,
+    batch_dist_calculator, positions)
+    compact = CompactCoverTree.from_tree(tree)
+    return (compact.top_level, compact.size, [ getattr(compact, name) for name in SNAPSHOT_ARRAYS ])
+
+def bisect_shards(values, n_shards, dist_calculator, batch_dist_calculator=None):
+    '''
+        split values into shards of near values of similar sizes. The biggest
+        shard is split until there are @n_shards: two far values a and b of
+        the shard are found, values are ordered by d(v,a)-d(v,b) and split at
+        the median
+
+        @values: a list of values
+        @n_shards: number of shards
+        @dist_calculator: function to calculate distance
+        @batch_dist_calculator: optional function to calculate distances between
+        one value and a stacked array of values
+
+        #return: a list of shards, each shard is a list of positions in @values
+    '''
+    tree = CoverTree(dist_calculator, 0, batch_dist_calculator)
+    stacked = np.array(values) if batch_dist_calculator is not None else None
+
+    def dists_to(p, shard):
+        vals = stacked[shard] if stacked is not None else [ values[i] for i in shard ]
+        return tree._calculate_val_dists(values[p], vals)
+
+    shards = [ range(len(values)) ]
+    while len(shards) < n_shards:
+        shards.sort(key=len)
+        shard = shards[-1]
+        if len(shard) < 2:
+            break
+        a = shard[np.argmax(dists_to(shard[0], shard))]
+        dists_a = dists_to(a, shard)
+        b = shard[np.argmax(dists_a)]
+        order = np.argsort(dists_a - dists_to(b, shard), kind='mergesort')
+        half = len(shard) / 2
+        shards[-1:] = [ [ shard[i] for i in sorted(order[:half]) ], [ shard[i] for i in sorted(order[half:]) ] ]
+    return shards
+
+def build_sharded(cls, values, dist_calculator, top_level, batch_dist_calculator=None,
+                  indices=None, shards=None, n_jobs=1):
+    '''
+        build trees of shards in a pool of forked processes and merge them
+        into the tree of the biggest shard. Merging grafts whole subtrees which
+        are far from other shards, so shards should group near values
+
+        @cls: class of the tree, CoverTree or its subclass
+        @values: a list of values
+        @dist_calculator: function to calculate distance
+        @top_level: level of root node shared by shards, None: fit to every shard
+        @batch_dist_calculator: optional function to calculate distances between
+        one value and a stacked array of values
+        @indices: optional list of node indices, default: position in @values
+        @shards: a list of lists of positions in @values, default: bisect_shards
+        @n_jobs: number of worker processes, -1: number of cpus
+
+        #return: a tree of class @cls
+    '''
+    global _shard_args
+
+    if indices is not None and len(indices) != len(values):
+        raise Exception('indices and values must share a common length')
+    if n_jobs < 0:
+        n_jobs = cpu_count()
+    if shards is None:
+        shards = bisect_shards(values, max(n_jobs, 1), dist_calculator, batch_dist_calculator)
+    shards = [ list(shard) for shard in shards if 0 != len(shard) ]
+
+    _shard_args = (values, dist_calculator, top_level, batch_dist_calculator)
+    try:
+        if n_jobs <= 1:
+            results = map(_build_shard, shards)
+        else:
+            pool = Pool(n_jobs)
+            try:
+                results = pool.map(_build_shard, shards)
+            finally:
+                pool.terminate()
+    finally:
+        _shard_args = None
+
+    trees = []
+    for shard_top_level, size, arrays in results:
+        compact = CompactCoverTree(dist_calculator, shard_top_level, batch_dist_calculator)
+        compact.size = size
+        for i, name in enumerate(SNAPSHOT_ARRAYS):
+            setattr(compact, name, arrays[i])
+        compact.values = [ values[p] for p in compact.indices ]
+        trees.append(compact.to_tree(cls))
+
+    trees.sort(key=lambda t: -t.size)
+    tree = trees[0]
+    if top_level is None:
+        tree.auto_top_level = True
+    for other in trees[1:]:
+        tree.merge(other)
+
+    if indices is not None:
+        index_nodes = {}
+        for level in tree.level_stack:
+            for n in level:
+                n.index = indices[n.index] if 0.0 != n.dist_to_prt else n.parent.index
+        for index, n in tree.index_nodes.iteritems():
+            index_nodes[indices[index]] = n
+        for n in tree.level_stack[-1]:
+            for sn in n.same_val_set:
+                sn.index = indices[sn.index]
+        tree.index_nodes = index_nodes
+    return tree
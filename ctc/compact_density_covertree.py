@@ -0,0 +1,130 @@
+#coding:utf-8
+
+import sys
+sys.path.append(sys.path[0] + '/../')
+from covertree.compact_covertree import CompactCoverTree
+import numpy as np
+
+class CompactDensityCoverTree(CompactCoverTree):
+
+    def __init__(self, dist_calculator, top_level, batch_dist_calculator=None):
+        '''
+            init function of compact density covertree, invoke father's init function
+
+            @dist_calculator: function to calculat distance
+            @top_level: level of root
+            @batch_dist_calculator: optional function to calculate distances between
+            one value and a stacked array of values
+        '''
+        CompactCoverTree.__init__(self, dist_calculator, top_level, batch_dist_calculator)
+
+    def estimate_density(self, node):
+        '''
+            esitmate density of a node based on PurTreeClust, same as
+            DensityCoverTree.estimate_density. A point and its self children
+            share one distance, so only distances to new children are calculated
+
+            @node: a (point, level) tuple
+
+            #return: density of @node
+        '''
+        return self._estimate_density(node)[0]
+
+    def estimate_density_bounds(self, node, max_depth=None, max_error=None):
+        '''
+            esitmate density of a node without descending every level, same as
+            DensityCoverTree.estimate_density_bounds
+
+            @node: a (point, level) tuple
+            @max_depth: max number of levels to descend, None: no limit
+            @max_error: stop when upper-lower <= max_error*lower, None: no limit
+
+            #return: (lower, upper), bounds of density of @node
+        '''
+        return self._estimate_density(node, max_depth, max_error)
+
+    def _estimate_density(self, node, max_depth=None, max_error=None):
+        '''
+            the real density estimation function, see estimate_density_bounds
+
+            @node: a (point, level) tuple
+            @max_depth: max number of levels to descend, None: no limit
+            @max_error: max relative error, None: no limit
+
+            #return: (lower, upper), lower == upper when every level is descended
+        '''
+        point, level = node
+        density = 0
+        stack_dep = len(self.level_ends)
+        eps = 2**(self.top_level-stack_dep-5)
+        # children in the band of the first level are within 2^(level+2)
+        q_i, d_i = self._points_near(point, level, 2**(level+2))
+
+        for depth, i in enumerate(xrange(level, self.top_level - stack_dep + 1, -1)):
+            if max_depth is not None or max_error is not None:
+                lower, upper = self._density_bounds(density, q_i, d_i, level, i)
+                if (max_depth is not None and depth >= max_depth) or \
+                (max_error is not None and upper - lower <= max_error * lower):
+                    return (lower, upper)
+
+            new_q = self._new_children(q_i, i-1)
+            q = np.concatenate((q_i, new_q))
+            d = np.concatenate((d_i, self._point_dists(point, new_q, 2**level+2**(i+1))))
+
+            alpha = d <= 2**level-2**(i+1)
+            density += np.sum(self._counts_at(q[alpha], i-1) - 1)
+
+            band = (d >= 2**level-2**(i+1)+eps) & (d <= 2**level+2**(i+1)-eps)
+            density += np.count_nonzero(~band & (d <= 2**level))
+            q_i = q[band]
+            d_i = d[band]
+
+        inside = q_i[d_i <= 2**level]
+        density += len(inside) + np.sum(self._same_sizes(inside))
+
+        return (int(density), int(density))
+
+    def _points_near(self, point, level, radius):
+        '''
+            find points of a level within a radius of a point, searching from
+            root down instead of calculating distances to the whole level.
+            Points under a point of level j are within 2^(j+1) of it
+
+            @point: the center point
+            @level: level to search
+            @radius: max distance
+
+            #return: (points, distances)
+        '''
+        points = np.zeros(1, dtype=np.int64)
+        dists = self._point_dists(point, points, radius + 2**(self.top_level+1))
+        for j in xrange(self.top_level-1, level-1, -1):
+            keep = dists <= radius + 2**(j+2)
+            points = points[keep]
+            new_points = self._new_children(points, j)
+            points = np.concatenate((points, new_points))
+            dists = np.concatenate((dists[keep], self._point_dists(point, new_points, radius + 2**(j+2))))
+        keep = dists <= radius
+        return (points[keep], dists[keep])
+
+    def _density_bounds(self, density, q_i, d_i, level, i):
+        '''
+            bounds of density when descending stops at points q_i of level i,
+            values under them are within 2^(i+1)
+
+            @density: density counted so far
+            @q_i: np.ndarray of points whose subtrees are not counted yet
+            @d_i: distances to q_i
+            @level: level of the estimated node
+            @i: level of q_i
+
+            #return: (lower, upper)
+        '''
+        counts = self._counts_at(q_i, i)
+        radius = 2**(i+1)
+        # whole subtrees inside, or only the point and its same values
+        inside = d_i <= 2**level - radius
+        partial = ~inside & (d_i <= 2**level)
+        lower = density + np.sum(counts[inside]) + np.count_nonzero(partial) + np.sum(self._same_sizes(q_i[partial]))
+        upper = density + np.sum(counts[d_i <= 2**level + radius])
+        return (int(lower), int(upper))
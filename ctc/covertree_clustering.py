@@ -5,68 +5,409 @@ sys.path.append(sys.path[0] + '/../')
 from covertree.covertree import CoverTree
 from covertree.node import Node
 from density_covertree import DensityCoverTree
+from compact_density_covertree import CompactDensityCoverTree
 import numpy as np
+from multiprocessing import Pool, cpu_count
 
-def covertree_clustering(dct, k):
+# tree shared with forked density workers
+_density_tree = None
+
+def _estimate_level_densities(args):
     '''
-        run covertree clustering algorithm
+        estimate densities of a slice of a level in a worker process
+
+        @args: (position of level in level stack, start, end, limits), limits
+        is None for exact densities or (max_depth, max_error) for bounds
+
+        #return: a list of densities or (lower, upper) bounds
+    '''
+    level_i, start, end, limits = args
+    level = _density_tree.level_stack[level_i]
+    if limits is None:
+        return [ _density_tree.estimate_density(level[i]) for i in xrange(start, end) ]
+    return [ _density_tree.estimate_density_bounds(level[i], *limits) for i in xrange(start, end) ]
+
+def estimate_densities(dct, level_i, n_jobs=1):
+    '''
+        estimate densities of all nodes of a level. Estimations are read-only
+        and independent, so with n_jobs > 1 the level is split into chunks and
+        estimated by a pool of forked processes which share the tree
 
         @dct: a density cover tree
+        @level_i: position of the level in level stack
+        @n_jobs: number of worker processes, -1: number of cpus
+
+        #return: a list of densities in order of the level
+    '''
+    return _estimate_level(dct, level_i, n_jobs, None)
+
+def estimate_density_bounds(dct, level_i, n_jobs=1, max_depth=None, max_error=None):
+    '''
+        estimate bounds of densities of all nodes of a level, see
+        estimate_densities and DensityCoverTree.estimate_density_bounds
+
+        @dct: a density cover tree
+        @level_i: position of the level in level stack
+        @n_jobs: number of worker processes, -1: number of cpus
+        @max_depth: max number of levels to descend, None: no limit
+        @max_error: max relative error of a density, None: no limit
+
+        #return: a list of (lower, upper) in order of the level
+    '''
+    return _estimate_level(dct, level_i, n_jobs, (max_depth, max_error))
+
+def _estimate_level(dct, level_i, n_jobs, limits):
+    '''
+        estimate densities or bounds of densities of all nodes of a level
+
+        @dct: a density cover tree
+        @level_i: position of the level in level stack
+        @n_jobs: number of worker processes, -1: number of cpus
+        @limits: None or (max_depth, max_error)
+
+        #return: a list of densities or (lower, upper) in order of the level
+    '''
+    global _density_tree
+
+    if n_jobs < 0:
+        n_jobs = cpu_count()
+    level = dct.level_stack[level_i]
+    if n_jobs <= 1 or len(level) < 2:
+        if limits is None:
+            return [ dct.estimate_density(n) for n in level ]
+        return [ dct.estimate_density_bounds(n, *limits) for n in level ]
+
+    # pending descendant counts are rolled up once instead of in every worker
+    if dct.__class__ == DensityCoverTree:
+        dct._roll_up_des_sum()
+    chunk_size = max(1, int(np.ceil(len(level) / float(n_jobs * 4))))
+    chunks = [ (level_i, start, min(start+chunk_size, len(level)), limits) for start in xrange(0, len(level), chunk_size) ]
+    _density_tree = dct
+    pool = Pool(n_jobs)
+    try:
+        densities = []
+        for chunk_densities in pool.map(_estimate_level_densities, chunks):
+            densities.extend(chunk_densities)
+    finally:
+        pool.terminate()
+        _density_tree = None
+    return densities
+
+def covertree_clustering(dct, k, n_jobs=1):
+    '''
+        run covertree clustering algorithm
+
+        @dct: a density cover tree, DensityCoverTree or CompactDensityCoverTree
         @k: number of clusters
+        @n_jobs: number of processes to estimate densities, -1: number of cpus
 
         #return: [label_1, label_2, ...]
     '''
+    return ClusteringSession(dct, n_jobs).cluster(k)
+
+class ClusteringSession:
+
+    def __init__(self, dct, n_jobs=1, max_depth=None, max_error=None):
+        '''
+            init function of ClusteringSession, which clusters one tree for
+            many k. Densities only depend on the tree, so candidate centers of
+            a level are estimated and sorted once and shared by every k
+            choosing the level. The tree must not change during a session.
+            With @max_depth or @max_error, candidates are ranked by the middle
+            of density bounds, and the bounds are kept in self.bounds
+
+            @dct: a density cover tree, DensityCoverTree or CompactDensityCoverTree
+            @n_jobs: number of processes to estimate densities, -1: number of cpus
+            @max_depth: max number of levels to descend for a density, None: no limit
+            @max_error: max relative error of a density, None: no limit
+        '''
+        #check dct
+        if dct.__class__ != DensityCoverTree and dct.__class__ != CompactDensityCoverTree:
+            raise Exception('arg#1 not a  density cover tree')
+
+        self.dct = dct
+        self.n_jobs = n_jobs
+        self.max_depth = max_depth
+        self.max_error = max_error
+        # position of level => nodes of level sorted by density, biggest first
+        self.candidates = {}
+        # position of level => (lower, upper) of candidates, for approximate densities
+        self.bounds = {}
+
+    def cluster(self, k):
+        '''
+            run covertree clustering algorithm with cached densities
+
+            @k: number of clusters
+
+            #return: [label_1, label_2, ...]
+        '''
+        return assign_labels(self.dct, self.centers(k))
+
+    def cluster_range(self, ks):
+        '''
+            run covertree clustering algorithm for every k
 
-    #check dct and k
-    if dct.__class__ != DensityCoverTree:
-        raise Exception('arg#1 not a  density cover tree')
-    if k<=0 or k>len(dct.level_stack[-1]):
-        raise Exception('invalid k')
-
-    # 1. find initial centers
-    # 1.1 calculate all densities of nodes in first valid level
-    candidate_centers = {}
-    for level in dct.level_stack:
-        #the first level that len(level) >= k or the first biggest level when max(len(level)) < k
-        if len(level) >= k or (len(level)<k and len(level)==len(dct.level_stack[-1])):
-            for n in level:
-                density_n = dct.estimate_density(n)
-                if not candidate_centers.has_key(density_n):
-                    candidate_centers[density_n] = []
-                candidate_centers[density_n].append(n)
-            break
-    sorted_densities = np.sort(candidate_centers.keys())
-    
-    # 1.2 find first k centers with biggest density
-    result_set = {}
-    k_size = 0
-    for density_i in xrange(len(sorted_densities)-1, -1, -1):
-        density = sorted_densities[density_i]
-        quit_loop = False
-
-        for center in candidate_centers[density]:
+            @ks: a list of k
+
+            #return: {k: [label_1, label_2, ...]}
+        '''
+        return dict([ (k, self.cluster(k)) for k in ks ])
+
+    def centers(self, k):
+        '''
+            find k centers with biggest density
+
+            @k: number of clusters
+
+            #return: a list of nodes
+        '''
+        if k<=0 or k>len(self.dct.level_stack[-1]):
+            raise Exception('invalid k')
+
+        result_set = {}
+        for center in self._candidates(self._level_of(k))[:k]:
             result_set[center] = []
-            k_size += 1
-            if k_size >= k:
-                quit_loop = True
-                break
-        if quit_loop:
-            break
-    
-    # 2. assign all nodes to their nearest node
-    dist = dct.dist_calculator
-    centers = result_set.keys()
-    labels = np.array([-1 for i in xrange(dct.size)])
-    for n in dct.level_stack[-1]:
-        clus = -1
-        min_dist = float('inf')
-        for i, c in enumerate(centers):
-            dist_c_n = dist(c.val,n.val)
-            if dist_c_n < min_dist:
-                min_dist = dist_c_n
-                clus = i
-        labels[n.index] = clus
-        for sn in n.same_val_set:
-            labels[sn.index] = clus
-
-    return labels
\ No newline at end of file
+        return result_set.keys()
+
+    def _level_of(self, k):
+        '''
+            the first level that len(level) >= k or the first biggest level when max(len(level)) < k
+
+            @k: number of clusters
+
+            #return: position of the level in level stack
+        '''
+        level_stack = self.dct.level_stack
+        for level_i, level in enumerate(level_stack):
+            if len(level) >= k or (len(level)<k and len(level)==len(level_stack[-1])):
+                return level_i
+
+    def _candidates(self, level_i):
+        '''
+            nodes of a level sorted by density, biggest first, nodes with a
+            same density are kept in order of the level
+
+            @level_i: position of the level in level stack
+
+            #return: a list of nodes
+        '''
+        if not self.candidates.has_key(level_i):
+            level = self.dct.level_stack[level_i]
+            if self.max_depth is None and self.max_error is None:
+                densities = estimate_densities(self.dct, level_i, self.n_jobs)
+            else:
+                bounds = estimate_density_bounds(self.dct, level_i, self.n_jobs, self.max_depth, self.max_error)
+                densities = [ (lower + upper) / 2.0 for lower, upper in bounds ]
+            order = sorted(xrange(len(level)), key=lambda i: -densities[i])
+            self.candidates[level_i] = [ level[i] for i in order ]
+            if self.max_depth is not None or self.max_error is not None:
+                self.bounds[level_i] = [ bounds[i] for i in order ]
+        return self.candidates[level_i]
+
+class OnlineClustering:
+
+    def __init__(self, dct, k, drift=0.1, n_jobs=1):
+        '''
+            init function of OnlineClustering, which labels values inserted to
+            a DensityCoverTree right away with their nearest center. Densities
+            of centers are kept up to date from the distances used for labels,
+            centers are chosen again when the density of a center or the size
+            of tree drifts by more than @drift since centers were chosen
+
+            @dct: a DensityCoverTree
+            @k: number of clusters
+            @drift: max relative drift before centers are chosen again
+            @n_jobs: number of processes to estimate densities, -1: number of cpus
+        '''
+        if dct.__class__ != DensityCoverTree:
+            raise Exception('arg#1 not a DensityCoverTree')
+        if drift <= 0:
+            raise Exception('drift must be positive')
+
+        self.dct = dct
+        self.k = k
+        self.drift = drift
+        self.n_jobs = n_jobs
+        self.recluster()
+
+    def recluster(self):
+        '''
+            choose centers with biggest density and label all values again
+        '''
+        self.centers = ClusteringSession(self.dct, self.n_jobs).centers(self.k)
+        self.radii = np.array([ np.power(2.0, c.level) for c in self.centers ])
+        self.base_densities = np.array([ self.dct.estimate_density(c) for c in self.centers ], dtype=np.float64)
+        self.densities = self.base_densities.copy()
+        self.base_size = self.dct.size
+        labels = assign_labels(self.dct, self.centers)
+        self.index_labels = dict([ (i, labels[i]) for i in np.flatnonzero(labels >= 0) ])
+
+    def insert(self, node):
+        '''
+            insert a node to tree and label it
+
+            @node: the node to be inserted
+
+            #return: label of @node, -1 if it is not inserted
+        '''
+        size = self.dct.size
+        self.dct.insert(node)
+        if self.dct.size == size:
+            return -1
+
+        dists = self.dct._dist_to_set(node, self.centers)
+        self.densities += dists <= self.radii
+        if self._drifted():
+            self.recluster()
+        else:
+            self.index_labels[node.index] = np.argmin(dists)
+        return self.index_labels[node.index]
+
+    def remove(self, index):
+        '''
+            remove the value of an index from tree
+
+            @index: index of the value
+
+            #return: True=>success; False=>index not in tree;
+        '''
+        if not self.dct.index_nodes.has_key(index):
+            return False
+        node = Node(val=self.dct.index_nodes[index].val)
+        self.dct.remove(index)
+        del self.index_labels[index]
+
+        # a center goes with its value unless a same value takes its place
+        removed_center = False
+        for c in self.centers:
+            removed_center = removed_center or not self.dct.index_nodes.has_key(c.index)
+        self.densities -= self.dct._dist_to_set(node, self.centers) <= self.radii
+        if removed_center or self._drifted():
+            self.recluster()
+        return True
+
+    def labels(self):
+        '''
+            labels of all values
+
+            #return: [label_1, label_2, ...]
+        '''
+        return _to_labels(self.index_labels.keys(), self.index_labels.values(), self.dct.size)
+
+    def _drifted(self):
+        '''
+            check if densities of centers or size of tree drift too far
+
+            #return: True=>centers should be chosen again
+        '''
+        if abs(self.dct.size - self.base_size) > self.drift * self.base_size:
+            return True
+        return np.any(np.abs(self.densities - self.base_densities) > self.drift * self.base_densities)
+
+def assign_labels(dct, centers):
+    '''
+        assign every value to its nearest center. Distances to stacked vectors
+        are calculated center by center when batch_dist_calculator is supplied,
+        otherwise the tree is searched for the nearest center
+
+        @dct: a density cover tree
+        @centers: a list of nodes
+
+        #return: [label_1, label_2, ...], label is position of center in @centers
+    '''
+    if dct.batch_dist_calculator is not None:
+        return _assign_labels_batch(dct, centers)
+    return _assign_labels_tree(dct, centers)
+
+def _assign_labels_batch(dct, centers):
+    '''
+        assign values to nearest centers with one batch distance call per center,
+        keeping the running minimum over centers
+
+        @dct: a density cover tree with batch_dist_calculator
+        @centers: a list of nodes
+
+        #return: [label_1, label_2, ...]
+    '''
+    bottom_level = dct.level_stack[-1]
+    vals = dct._stack_vals(list(bottom_level))
+    center_vals = dct._stack_vals(centers)
+    nearest = np.zeros(len(bottom_level), dtype=np.int64)
+    nearest_dists = np.repeat(np.inf, len(bottom_level))
+    for c in xrange(len(centers)):
+        dists = dct._calculate_val_dists(center_vals[c], vals)
+        # strict comparison keeps the first of equally near centers
+        closer = dists < nearest_dists
+        nearest[closer] = c
+        nearest_dists[closer] = dists[closer]
+
+    indices = []
+    index_labels = []
+    for i, n in enumerate(bottom_level):
+        for index in dct._node_indices(n):
+            indices.append(index)
+            index_labels.append(nearest[i])
+    return _to_labels(indices, index_labels, dct.size)
+
+def _assign_labels_tree(dct, centers):
+    '''
+        assign values to nearest centers searching the tree from root down.
+        Values under a node of level l are within 2^(l+1) of the node, so a
+        center is dropped for the whole subtree once its distance to the node
+        exceeds the distance to the nearest center by 2^(l+2). Ties are kept
+        and broken by order of @centers at bottom level
+
+        @dct: a density cover tree
+        @centers: a list of nodes
+
+        #return: [label_1, label_2, ...]
+    '''
+    indices = []
+    index_labels = []
+    bottom_i = len(dct.level_stack) - 1
+    root = dct.level_stack[0][0]
+    frontier = [(root, np.arange(len(centers)), dct._dist_to_set(root, centers))]
+    for level_i in xrange(len(dct.level_stack)):
+        radius = np.power(2.0, dct.top_level - level_i + 1)
+        next_frontier = []
+        for n, cands, dists in frontier:
+            if bottom_i == level_i:
+                clus = cands[dists.argmin()]
+                for index in dct._node_indices(n):
+                    indices.append(index)
+                    index_labels.append(clus)
+                continue
+
+            if 1 != len(cands):
+                keep = dists <= dists.min() + 2*radius
+                cands = cands[keep]
+                dists = dists[keep]
+            self_chd, chd_set = dct._split_children(n)
+            # self child shares the distances of its parent
+            if self_chd is not None:
+                next_frontier.append((self_chd, cands, dists))
+            for chd in chd_set:
+                if 1 == len(cands):
+                    next_frontier.append((chd, cands, dists))
+                else:
+                    next_frontier.append((chd, cands, dct._dist_to_set(chd, [ centers[c] for c in cands ])))
+        frontier = next_frontier
+
+    return _to_labels(indices, index_labels, dct.size)
+
+def _to_labels(indices, index_labels, size):
+    '''
+        put labels of indices in an array, indices removed from tree are labeled -1
+
+        @indices: a list of indices
+        @index_labels: a list of labels in order of @indices
+        @size: number of values in tree, the array covers at least indices below it
+
+        #return: [label_1, label_2, ...]
+    '''
+    if 0 != len(indices):
+        size = max(size, max(indices)+1)
+    labels = np.array([-1 for i in xrange(size)])
+    labels[indices] = index_labels
+    return labels
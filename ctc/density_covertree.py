@@ -7,14 +7,16 @@ from covertree.covertree import CoverTree
 
 class DensityCoverTree(CoverTree) :
     
-    def __init__(self, dist_calculator, top_level):
+    def __init__(self, dist_calculator, top_level, batch_dist_calculator=None):
         '''
             init function of density covertree, invoke father's init function
 
             @dist_calculator: function to calculat distance
             @top_level: level of root
+            @batch_dist_calculator: optional function to calculate distances between
+            one value and a stacked array of values
         '''
-        CoverTree.__init__(self, dist_calculator, top_level)
+        CoverTree.__init__(self, dist_calculator, top_level, batch_dist_calculator)
 
     def estimate_density(self, node):
         '''
@@ -25,14 +27,60 @@ class DensityCoverTree(CoverTree) :
             #return: density of @node, long type
         '''
         
+        return self.estimate_density_bounds(node)[0]
+
+    def estimate_density_bounds(self, node, max_depth=None, max_error=None):
+        '''
+            esitmate density of a node without descending every level. Values
+            under a node of level i are within 2^(i+1) of it, so when descending
+            stops, des_sum of the nodes left bounds the density: subtrees far
+            inside count to both bounds, subtrees crossing the radius count
+            to the upper bound only
+
+            @node: node to estimate
+            @max_depth: max number of levels to descend, None: no limit
+            @max_error: stop when upper-lower <= max_error*lower, None: no limit
+
+            #return: (lower, upper), bounds of density of @node, equal when
+            every level is descended
+        '''
+        self._roll_up_des_sum()
+        opened = self._open_dist_cache(node)
+        try:
+            return self._estimate_density(node, max_depth, max_error)
+        finally:
+            if opened:
+                self._close_dist_cache()
+
+    def _estimate_density(self, node, max_depth=None, max_error=None):
+        '''
+            the real density estimation function, distances are served by
+            the distance cache opened in estimate_density_bounds
+
+            @node: node to estimate
+            @max_depth: max number of levels to descend, None: no limit
+            @max_error: max relative error, None: no limit
+
+            #return: (lower, upper)
+        '''
         density = 0
         inf = float('inf')
         level = node.level
-        q_i = self.level_stack[self.top_level - level]
+        # children in the band of the first level are within 2^(level+2)
+        q_i = self._nodes_near(node, level, 2**(level+2))
         stack_dep = len(self.level_stack)
     
-        for i in xrange(level, self.top_level - stack_dep + 1, -1):
+        for depth, i in enumerate(xrange(level, self.top_level - stack_dep + 1, -1)):
+            if max_depth is not None or max_error is not None:
+                lower, upper = self._density_bounds(node, q_i, density, level, i)
+                if (max_depth is not None and depth >= max_depth) or \
+                (max_error is not None and upper - lower <= max_error * lower):
+                    return (lower, upper)
+
             q = self._get_children_set(q_i)
+            # distances are needed up to the top of the band, the filters
+            # below are served by the cache
+            self._dist_to_set(node, q, 2**level+2**(i+1))
             alpha = self._filter(node, q, -inf, 2**level-2**(i+1))
             
             for n in alpha:
@@ -45,8 +93,52 @@ class DensityCoverTree(CoverTree) :
             density += len(self._subset(q, q_i, node, level))
         density += self._amount_and_self_chds(self._filter(node, q_i, -inf, 2**level))
 
-        return density
-        
+        return (density, density)
+
+    def _nodes_near(self, node, level, radius):
+        '''
+            find nodes of a level within a radius of a node, searching from
+            root down instead of calculating distances to the whole level.
+            Nodes under a node of level j are within 2^(j+1) of it
+
+            @node: the center node
+            @level: level to search
+            @radius: max distance
+
+            #return: a list of nodes
+        '''
+        q = [self.root_node]
+        for j in xrange(self.top_level-1, level-1, -1):
+            dists = self._dist_to_set(node, q, radius + 2**(j+2))
+            q = self._get_children_set([ n for i, n in enumerate(q) if dists[i] <= radius + 2**(j+2) ])
+        dists = self._dist_to_set(node, q, radius)
+        return [ n for i, n in enumerate(q) if dists[i] <= radius ]
+
+    def _density_bounds(self, node, q_i, density, level, i):
+        '''
+            bounds of density when descending stops at nodes q_i of level i
+
+            @node: node to estimate
+            @q_i: nodes whose subtrees are not counted yet
+            @density: density counted so far
+            @level: level of @node
+            @i: level of q_i
+
+            #return: (lower, upper)
+        '''
+        radius = 2**(i+1)
+        dists = self._dist_to_set(node, q_i, 2**level + radius)
+        lower = density
+        upper = density
+        for j, n in enumerate(q_i):
+            count = n.des_sum + len(n.same_val_set) + 1
+            if dists[j] <= 2**level - radius:
+                lower += count
+            elif dists[j] <= 2**level:
+                lower += len(n.same_val_set) + 1
+            if dists[j] <= 2**level + radius:
+                upper += count
+        return (lower, upper)
 
     def _subset(self, q, q_i, node, l):
         '''
@@ -60,13 +152,11 @@ class DensityCoverTree(CoverTree) :
             #return: set satisfies condistions
         '''
 
-        def condition(n):
-            dist = self.dist_calculator(node.val, n.val)
-            return n not in q_i and dist <= 2**l
-        # return filter(condition, q)
+        dists = self._dist_to_set(node, q, 2**l)
+        q_i_set = set(q_i)
         ret_list = []
-        for n in q:
-            if condition(n):
+        for i, n in enumerate(q):
+            if n not in q_i_set and dists[i] <= 2**l:
                 ret_list.append(n)
         return ret_list
 
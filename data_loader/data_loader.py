@@ -34,6 +34,35 @@ class DataLoader:
         with open(self.business_file_name) as businss_cate_json:
             self.business_cate = json.load(businss_cate_json)
 
+    def load_users(self, **kwargs):
+        '''
+            load businesses of users and category paths of the businesses,
+            for batch_vectorized_convertor
+
+            @kwargs: valid_uid and data_size as of load
+
+            #return: (uids, user_bus_dict, bus_cate_dict), uids is a list of
+            user ids in order, user_bus_dict is a dict {uid: [business_1, ...]}
+            and bus_cate_dict is a dict {business_1: [[path_1],[path_2],...], ...}
+        '''
+        with open(self.data_file_name) as user_data_f:
+            user_data = json.load(user_data_f)
+
+        valid_uid = kwargs['valid_uid'] if kwargs.has_key('valid_uid') else user_data.keys()
+        data_size = kwargs['data_size'] if kwargs.has_key('data_size') else float('inf')
+        if valid_uid is None:
+            valid_uid = user_data.keys()
+        uids = valid_uid[:int(min(data_size, len(valid_uid)))]
+
+        user_bus_dict = {}
+        bus_cate_dict = {}
+        for uid in uids:
+            user_bus_dict[uid] = user_data[uid]
+            for bid in user_data[uid]:
+                if not bus_cate_dict.has_key(bid):
+                    bus_cate_dict[bid] = self.get_business_cate_path(bid)
+        return (uids, user_bus_dict, bus_cate_dict)
+
     def get_cate_list(self, cate):
         '''
             get a category's category path from root category
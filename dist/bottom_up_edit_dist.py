@@ -1,5 +1,53 @@
 #coding:utf-8
-from Queue import Queue
+from collections import Counter
+import hashlib
+
+# signature of all leaves, labels of leaves are compared only after mapping
+LEAF_SIGNATURE = 0
+
+def _signature(label, chd_items):
+    '''
+        hash-consed signature of a subtree, two subtrees share a signature
+        when their roots share a label and their children share a multiset
+        of signatures. Heights follow from children, so they are not hashed.
+        A hash of the content is used as the id, so trees built in different
+        processes or loaded from disk stay comparable
+
+        @label: label of the root of the subtree
+        @chd_items: sorted (signature of child, count) pairs
+
+        #return: int
+    '''
+    if isinstance(label, unicode):
+        label = label.encode('utf-8')
+    digest = hashlib.md5('%d:%s' % (len(label), label))
+    for sig, count in chd_items:
+        digest.update('|%d*%d' % (sig, count))
+    return int(digest.hexdigest()[:15], 16)
+
+class LabelTable:
+
+    def __init__(self):
+        '''
+            init function of LabelTable, which keeps every leaf label of
+            compacted BUEditTrees as one shared string, so a business
+            reviewed by many users keeps one copy of its id
+        '''
+        # label => the shared label
+        self.labels = {}
+
+    def intern_label(self, label):
+        '''
+            get the shared string of a label
+
+            @label: a label
+
+            #return: the shared label
+        '''
+        return self.labels.setdefault(label, label)
+
+# the table shared by all trees of a process
+label_table = LabelTable()
 
 class BUEditTreeNode:
 
@@ -16,8 +64,13 @@ class BUEditTreeNode:
         self.parent = parent
         self.des_sum = 0
         self.chd_set = []
+        # label => the first child with the label
+        self.chd_map = {}
         self.unprocessed_son_size = 0
         self.root = None
+        self.signature = None
+        # signature of child => number of children with the signature
+        self.chd_signatures = {}
 
 class BUEditTree:
 
@@ -28,8 +81,17 @@ class BUEditTree:
         '''
         self.root = BUEditTreeNode(tree_name, 0, None)
         self.root.root = self.root
-        self.leaves_set = []
+        self.leaves_set = set()
         self.size = 1
+        # signature => set of nodes with the signature, leaves excluded
+        self.signature_nodes = {}
+        # set by compact: signature => number of nodes, inner nodes from the
+        # highest down, see _node_list, and signature => their positions
+        self.compacted = False
+        self.subtree_counts = None
+        self.nodes = None
+        self.signature_positions = None
+        self.leaves_size = 0
     
     def insert(self, label_list):
         '''
@@ -37,231 +99,334 @@ class BUEditTree:
 
             @label_list: a list of string, which is cate_path + business_id
         '''
+        if self.compacted:
+            raise Exception('a compacted tree can not be changed')
 
-        node_stack = []
-        node_stack.append(self.root)
+        path = [self.root]
         p = self.root
+        created = 0
 
         #insert node to tree
         for i, label in enumerate(label_list):
             next_p = None
-            for chd in p.chd_set:
-                if label!=label_list[-1] and label==chd.label:
-                    next_p = chd
+            if label!=label_list[-1]:
+                next_p = p.chd_map.get(label)
+                if next_p is not None:
                     # remove duplicated leaves nodes
-                    if next_p in self.leaves_set:
-                        self.leaves_set.remove(next_p)
-                    break
+                    self.leaves_set.discard(next_p)
             if next_p is None:
                 next_p = BUEditTreeNode(label, -1, p)
                 next_p.root = self.root
                 p.chd_set.append(next_p)
+                p.chd_map.setdefault(label, next_p)
                 p.unprocessed_son_size += 1
                 self.size += 1
-            node_stack.append(next_p)
+                created += 1
+            path.append(next_p)
             
             #add leaf node to leaves set
             if i == len(label_list)-1:
-                self.leaves_set.append(next_p)
+                self.leaves_set.add(next_p)
             p = next_p
 
-        #pop node_stack to update height and descendants sum
-        while 0!=len(node_stack):
-            current_node = node_stack.pop()
+        #new nodes are the tail of the path, so every node of the path gains
+        #the new nodes below it, and heights only grow along the path
+        chd = None
+        for j in xrange(len(path)-1, -1, -1):
+            current_node = path[j]
             if 0==len(current_node.chd_set):
                 current_node.height = 1
                 current_node.des_sum = 0
-                continue
+            elif chd is not None:
+                current_node.des_sum += min(created, len(path)-1-j)
+                current_node.height = max(current_node.height, chd.height)
+            chd = current_node
 
-            max_height = -float('inf')
-            total_des = len(current_node.chd_set)
-            for chd in current_node.chd_set:
-                max_height = chd.height if chd.height > max_height else max_height
-                total_des += chd.des_sum
-            current_node.height = max_height
-            current_node.des_sum = total_des
+        #signatures change only along the path, from the leaf up
+        for current_node in reversed(path):
+            self._update_signature(current_node)
 
-class __GraphNode:
-
-    def __init__(self, label, height, index):
+    def _update_signature(self, node):
         '''
-            init function of __GraphNode
+            update signature of a node from signatures of its children, and
+            move the node in signature_nodes and in the children signatures
+            of its parent
 
-            @label: label represented by __GraphNode
-            @height: height of nodes represented by __GraphNode
-            @index: index of the __GraphNode
+            @node: a node whose children are up to date
+        '''
+        if 0==len(node.chd_set):
+            signature = LEAF_SIGNATURE
+        else:
+            signature = _signature(node.label, tuple(sorted(node.chd_signatures.iteritems())))
+        if signature == node.signature:
+            return
+
+        if node.signature is not None and node.signature != LEAF_SIGNATURE:
+            same_nodes = self.signature_nodes[node.signature]
+            same_nodes.discard(node)
+            if 0==len(same_nodes):
+                del self.signature_nodes[node.signature]
+        if signature != LEAF_SIGNATURE:
+            self.signature_nodes.setdefault(signature, set()).add(node)
+
+        if node.parent is not None:
+            chd_signatures = node.parent.chd_signatures
+            if node.signature is not None:
+                chd_signatures[node.signature] -= 1
+                if 0==chd_signatures[node.signature]:
+                    del chd_signatures[node.signature]
+            chd_signatures[signature] = chd_signatures.get(signature, 0) + 1
+        node.signature = signature
+
+    def compact(self):
+        '''
+            keep only the signatures, leaf labels and children of inner nodes
+            which the distance needs, and drop all nodes but the root. Leaf
+            labels are shared through label_table. A compacted tree can not
+            be changed
         '''
+        if self.compacted:
+            return
+        self.subtree_counts = _subtree_counts(self)
+        self.nodes = _node_list(self, label_table.intern_label)
+        self.signature_positions = _signature_positions(self.nodes)
+        self.compacted = True
+        self.leaves_size = len(self.leaves_set)
+        self.root.chd_set = []
+        self.root.chd_map = {}
+        self.root.chd_signatures = {}
+        self.leaves_set = set()
+        self.signature_nodes = {}
+
+def bottomup_edit_dist_calculator(t1, t2, upper_bound=None):
+    '''
+        calculate bottom up distance between t1 and t2. Nodes are mapped with
+        their whole subtrees, so a node of t1 is mapped iff an equal subtree
+        of t2 is left, and min(count in t1, count in t2) nodes of every
+        signature are mapped together with their leaves. Nodes of t1 are
+        visited from the highest subtrees down, so the subtree of a free node
+        of t2 is free as a whole, and a node not mapped with its parent takes
+        the free node of its signature sharing most leaf labels with it.
+        Leaves are only paired inside a pair of mapped nodes, a mapped leaf
+        costs a substitution unless its label is paired.
+        Inner nodes and leaves are only mapped to their own kind, so
+        |inner1-inner2| + |leaves1-leaves2| bounds the distance from below,
+        and the bound rises as signatures fail to match. With @upper_bound
+        the calculation stops once the lower bound exceeds it
 
-        self.index = index
-        self.label = label
-        self.height = height
-        self.out_set = []
-        self.in_set = []
-        self.node_set = []
+        @t1: one BUEditTree
+        @t2: one BUEditTree
+        @upper_bound: optional, distances above it are not needed
 
+        #return: bottom up distance, or a lower bound of it which exceeds
+        @upper_bound
+    '''
 
-def __compact(t1, t2, graph, k):
+    if t1 is t2:
+        return 0.0
+    if upper_bound is not None:
+        # bounds of cover trees are numpy floats, which are slow to compare
+        upper_bound = float(upper_bound)
+
+    #root nodes are ignored when they differ
+    roots = 1 if t1.root.label != t2.root.label else 0
+    leaves1 = _leaves_size(t1)
+    leaves2 = _leaves_size(t2)
+    inner1 = t1.size - leaves1
+    inner2 = t2.size - leaves2
+    # the lower bound is base - 2*min(possible, most) + si, where possible
+    # is the number of inner nodes which are mapped or may still be mapped
+    base = inner1 + inner2 - 2*roots + abs(leaves1 - leaves2)
+    most = min(inner1, inner2) - roots
+    if upper_bound is not None:
+        # the bound is exceeded once min(possible, most) < target
+        target = (base - upper_bound) / 2.0
+        if most < target:
+            return base - 2*most
+
+    counts1 = _subtree_counts(t1)
+    counts2 = _subtree_counts(t2)
+    # pairs are ordered the same way both ways round, so the greedy
+    # choice of partners and the distance are symmetric
+    key1 = (len(counts1), t1.size, t1.root.label)
+    key2 = (len(counts2), t2.size, t2.root.label)
+    if key1 > key2 or (key1 == key2 and sorted(counts1.items()) > sorted(counts2.items())):
+        t1, t2 = t2, t1
+        counts1, counts2 = counts2, counts1
+    possible = t1.size - _leaves_size(t1)
+
+    for sig, count1 in counts1.iteritems():
+        count2 = counts2.get(sig, 0)
+        if count1 > count2:
+            possible -= count1 - count2
+            if upper_bound is not None and possible < target:
+                return base - 2*min(possible, most)
+
+    nodes1 = _node_list(t1)
+    nodes2 = _node_list(t2)
+    positions2 = t2.signature_positions if t2.compacted else _signature_positions(nodes2)
+    # free nodes of t2 by signature and leaf label, indexed on first use,
+    # and the first free node of every signature
+    label_free2 = {}
+    first_free2 = {}
+    mapped1 = [False] * len(nodes1)
+    mapped2 = [False] * len(nodes2)
+
+    mapped = 0
+    mapped_leaves = 0
+    si = 0
+    # nodes are in order of height, so a mapped node of t2 is never below
+    # a node mapped later
+    for i, (sig, labels, chd) in enumerate(nodes1):
+        if mapped1[i] or not positions2.has_key(sig):
+            continue
+        free = positions2[sig]
+        # the free node sharing most leaf labels, the first free node when
+        # no labels are shared
+        partner = None
+        if labels is not None and 1 < len(free):
+            if not label_free2.has_key(sig):
+                label_free2[sig] = {}
+                for j in free:
+                    for label in nodes2[j][1] or ():
+                        label_free2[sig].setdefault(label, []).append(j)
+            shared = {}
+            for label, count in labels.iteritems():
+                for j in label_free2[sig].get(label, ()):
+                    if not mapped2[j]:
+                        shared[j] = shared.get(j, 0) + min(count, nodes2[j][1][label])
+            if 0!=len(shared):
+                partner = min(shared, key=lambda j: (-shared[j], j))
+        if partner is None:
+            first = first_free2.get(sig, 0)
+            while first < len(free) and mapped2[free[first]]:
+                first += 1
+            first_free2[sig] = first
+            if first == len(free):
+                continue
+            partner = free[first]
+
+        # subtrees are mapped pair by pair, children of a mapped pair are
+        # paired by signature, and by shared leaf labels among equal ones
+        pairs = [(i, partner)]
+        while 0!=len(pairs):
+            n1, n2 = pairs.pop()
+            mapped1[n1] = True
+            mapped2[n2] = True
+            mapped += 1
+            labels1 = nodes1[n1][1]
+            if labels1 is not None:
+                leaves = sum(labels1.values())
+                mapped_leaves += leaves
+                substituted = leaves - _shared_leaves(labels1, nodes2[n2][1])
+                if 0!=substituted:
+                    si += substituted
+                    if upper_bound is not None and base - 2*min(possible, most) + si > upper_bound:
+                        return base - 2*min(possible, most) + si
+            chd2 = {}
+            for c in nodes2[n2][2]:
+                chd2.setdefault(nodes2[c][0], []).append(c)
+            for c in nodes1[n1][2]:
+                same = chd2[nodes1[c][0]]
+                k = 0
+                if 1 < len(same) and nodes1[c][1] is not None:
+                    k = max(xrange(len(same)), key=lambda k: (_shared_leaves(nodes1[c][1], nodes2[same[k]][1]), -k))
+                pairs.append((c, same.pop(k)))
+
+    return t1.size + t2.size - 2*(mapped + mapped_leaves) - 2*roots + si
+
+
+def _shared_leaves(labels1, labels2):
     '''
-        compact t1 and t2 to @graph and @k
-        
-        @t1: CateTree
-        @t2: CateTree
-        @graph: a list of __GraphNode
-        @k: a dict whose keys are CateTreeNode and values are __GraphNode
+        number of leaves paired by label between two mapped nodes
+
+        @labels1: Counter of labels of leaf children, or None
+        @labels2: Counter of labels of leaf children, or None
+
+        #return: int
     '''
+    if labels1 is None or labels2 is None:
+        return 0
+    shared = 0
+    for label, count in labels1.iteritems():
+        if labels2.has_key(label):
+            shared += min(count, labels2[label])
+    return shared
 
-    traveseQueue = Queue()
-
-    leaf_gn = __GraphNode('leaf', 1, len(graph))
-    graph.append(leaf_gn)
-
-    for leaf_node in t1.leaves_set + t2.leaves_set:
-        leaf_gn.node_set.append(leaf_node)
-        traveseQueue.put(leaf_node)
-        k[leaf_node] = leaf_gn
-    while not traveseQueue.empty():
-        
-        v = traveseQueue.get()
-        if 0!=len(v.chd_set):
-            found = False
-            # travese graph reversely to see if there are equal class
-            for g_i in xrange(len(graph)-1, -1, -1):
-                w = graph[g_i]
-                if len(w.out_set)!=len(v.chd_set) or w.label!=v.label or w.height!=v.height:
-                    continue
-                
-                is_same = True
-                #get equal class of child nodes
-                w_chd_eq_cls = w.out_set
-                v_chd_eq_cls = []
-                for n in v.chd_set:
-                    v_chd_eq_cls.append(k[n])
-
-                #sorted by index of __GraphNode and compare them
-                srted_w_chd_eq_cls = sorted(w_chd_eq_cls, cmp=lambda x,y:cmp(x.index, y.index))
-                srted_v_chd_eq_cls = sorted(v_chd_eq_cls, cmp=lambda x,y:cmp(x.index, y.index))
-                for w_i in xrange(len(srted_w_chd_eq_cls)):
-                    w_n = srted_w_chd_eq_cls[w_i]
-                    v_n = srted_v_chd_eq_cls[w_i]
-                    if 0!=cmp(w_n.index, v_n.index):
-                        is_same = False
-                        break
-                if is_same:
-                    if k.has_key(v) and k[v].index!=w.index:
-                        raise Exception('error when set K[v]: K[v] has been set')
-                    k[v] = w
-                    w.node_set.append(v)
-                    found = True
-                    break
-            # if not found, add a new __GraphNode
-            if not found:
-                new_gn = __GraphNode(v.label, v.height, len(graph))
-                k[v] = new_gn
-                for chd in v.chd_set:
-                    if not k.has_key(chd):
-                        raise Exception('not all children of v are in K')
-                    k[chd].in_set.append(new_gn)
-                    new_gn.out_set.append(k[chd])                
-                graph.append(new_gn)
-        if v!=t1.root and v!=t2.root:
-            v.parent.unprocessed_son_size -= 1
-            if 0==v.parent.unprocessed_son_size:
-                traveseQueue.put(v.parent)
-                v.parent.unprocessed_son_size = len(v.parent.chd_set) # recover unrocessed_son_size to supply next computation
-     
-def __mapping(t1, t2, graph, k, m12, m21):
+
+def _leaves_size(t):
     '''
-        map nodes between t1 and t2
-
-        @t1: a CateTree
-        @t2: a CateTree
-        @graph: a list of __GraphNode
-        @k: a dict, whose keys are CateTreeNode, whose values are __GraphNode
-        @m12: a empty dict, map nodes in t1 to nodes in t2
-        @m21: a empty dict, map nodes in t2 to nodes in t1
+        number of leaves of a tree
+
+        @t: a BUEditTree
+
+        #return: int
     '''
-    if len(graph)==0 or len(k)==0:
-        raise Exception('graph/K empty')
-    traverse_queue = Queue()
-    traverse_queue.put(t1.root)
-    while not traverse_queue.empty():
-        # poll a BUEditTreeNode:
-        v = traverse_queue.get()
-        # leaf node's mapping is delivered to their parent node
-        if 0==len(v.chd_set):
-            continue
-        # chd nodes enqueue
-        for n in v.chd_set:
-            traverse_queue.put(n)
-        # map
-        if not m12.has_key(v):
-            #unordered tree, there is no need to find the first left equal class
-            w = None
-            gn = k[v]
-            for eqn in gn.node_set:
-                if eqn.root==t2.root and not m21.has_key(eqn):
-                    w = eqn
-                    break
-            if w is None:
-                continue
-            if not k.has_key(w):
-                raise Exception('error in mapping: w not in k')
-            if k[w] != k[v]:
-                raise Exception('graph and K do not consist')
-
-            #using queue to map trees of v and w
-            w_queue = Queue()
-            v_queue = Queue()
-            w_queue.put(w)
-            v_queue.put(v)
-            while not w_queue.empty():
-                n_w_queue = w_queue.get()
-                n_v_queue = v_queue.get()
-                m12[n_v_queue] = n_w_queue
-                m21[n_w_queue] = n_v_queue
-                #sort chd_set to ensure responsing
-                srted_nw_chd = sorted(n_w_queue.chd_set, cmp=lambda x,y:cmp(k[x].label, k[y].label))
-                srted_nv_chd = sorted(n_v_queue.chd_set, cmp=lambda x,y:cmp(k[x].label, k[y].label))
-                for i in xrange(len(srted_nw_chd)):
-                    if len(srted_nv_chd) != len(srted_nw_chd):
-                        print 'stub'
-                    w_queue.put(srted_nw_chd[i])
-                    v_queue.put(srted_nv_chd[i])
-
-
-
-def bottomup_edit_dist_calculator(t1, t2):
+    if t.compacted:
+        return t.leaves_size
+    return len(t.leaves_set)
+
+
+def _subtree_counts(t):
     '''
-        calculate bottom up distance between t1 and t2
+        count nodes of every signature of a tree, leaves excluded
 
-        @t1: one BUEditTree
-        @t2: one BUEditTree
+        @t: a BUEditTree
 
-        #return: bottom up distance
+        #return: a dict whose keys are signatures and values are counts
     '''
+    if t.compacted:
+        return t.subtree_counts
+    return dict([ (sig, len(nodes)) for sig, nodes in t.signature_nodes.iteritems() ])
 
-    if t1 is t2:
-        return 0.0
 
-    graph = []
-    k = {}
-    m12 = {}
-    m21 = {}
+def _node_list(t, label_of=None):
+    '''
+        inner nodes of a tree from the highest subtrees down, nodes of a
+        height in breadth first order, children in order of insertion
+
+        @t: a BUEditTree
+        @label_of: optional, callable giving the label kept for a leaf label
+
+        #return: a list of (signature, Counter of labels of leaf children or
+        None when there are none, positions of inner children in the list)
+    '''
+    if t.compacted:
+        return t.nodes
+    order = [t.root] if 0!=len(t.root.chd_set) else []
+    for n in order:
+        for chd in n.chd_set:
+            if 0!=len(chd.chd_set):
+                order.append(chd)
+    heights = {}
+    for n in reversed(order):
+        heights[n] = 1 + max([0] + [ heights[chd] for chd in n.chd_set if 0!=len(chd.chd_set) ])
+    order = [ n for i, n in sorted(enumerate(order), key=lambda (i, n): (-heights[n], i)) ]
+    positions = dict([ (n, i) for i, n in enumerate(order) ])
+    nodes = []
+    for n in order:
+        labels = Counter()
+        for chd in n.chd_set:
+            if 0==len(chd.chd_set):
+                labels[chd.label if label_of is None else label_of(chd.label)] += 1
+        nodes.append((n.signature, labels if 0!=len(labels) else None,
+        tuple([ positions[chd] for chd in n.chd_set if 0!=len(chd.chd_set) ])))
+    return nodes
+
+
+def _signature_positions(nodes):
+    '''
+        positions of nodes of every signature in a list of _node_list
 
-    __compact(t1, t2, graph, k)
-    __mapping(t1, t2, graph, k, m12, m21)
-    d = t1.size - len(m12)
-    i = t2.size - len(m12)
-    #ignore the root node
-    if t1.root.label != t2.root.label:
-        d -= 1
-        i -= 1
+        @nodes: a list of _node_list
 
-    si = 0
-    for e in m12.keys():
-        if e.label != m12[e].label:
-            si += 1
-    return d + i + si
+        #return: a dict whose keys are signatures and values are lists of
+        positions in increasing order
+    '''
+    positions = {}
+    for i, n in enumerate(nodes):
+        positions.setdefault(n[0], []).append(i)
+    return positions
 
 
 def bottomup_edit_dist_converter(uid, bus_cate_dict, kwargs):
@@ -282,6 +447,7 @@ def bottomup_edit_dist_converter(uid, bus_cate_dict, kwargs):
             path_set.append(p)
     for path in path_set:
         t.insert(path)
+    t.compact()
     return t
 
 
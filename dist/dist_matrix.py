@@ -0,0 +1,396 @@
+#coding:utf-8
+
+from multiprocessing import Pool, cpu_count
+from scipy import sparse
+import numpy as np
+
+# (data, dist_calculator, batch_dist_calculator, kernel, dtype) shared with forked block workers
+_matrix_args = None
+# (data, tree, radius, k) shared with forked tree query workers
+_graph_args = None
+
+def _blocks(size, block_size):
+    '''
+        blocks of the upper triangle of a square matrix, diagonal blocks included
+
+        @size: number of rows
+        @block_size: number of rows and columns of a block
+
+        #return: a list of (row start, row end, column start, column end)
+    '''
+    starts = range(0, size, block_size)
+    return [ (i, min(i+block_size, size), j, min(j+block_size, size)) for i in starts for j in starts if j >= i ]
+
+def _block_dists(block):
+    '''
+        calculate a block of the matrix in a worker process, the kernel is
+        applied to the whole block at once
+
+        @block: (row start, row end, column start, column end)
+
+        #return: (@block, np.ndarray of shape (row end-row start, column end-column start)),
+        in a diagonal block only entries above the diagonal are set
+    '''
+    data, dist_calculator, batch_dist_calculator, kernel, dtype = _matrix_args
+    i0, i1, j0, j1 = block
+    dists = np.zeros((i1-i0, j1-j0))
+    for i in xrange(i0, i1):
+        # in a diagonal block only columns after i are needed
+        start = max(j0, i+1)
+        if start >= j1:
+            continue
+        if batch_dist_calculator is not None:
+            dists[i-i0, start-j0:] = batch_dist_calculator(data[i], data[start:j1])
+        else:
+            for j in xrange(start, j1):
+                dists[i-i0, j-j0] = dist_calculator(data[i], data[j])
+    if kernel is not None:
+        dists = kernel(dists)
+    return (block, np.asarray(dists, dtype=dtype))
+
+def _calculate_blocks(data, dist_calculator, kernel, batch_dist_calculator, dtype,
+                      block_size, n_jobs, write):
+    '''
+        calculate blocks of the upper triangle in a pool of forked processes
+
+        @data: a list of data points, or a 2-d np.ndarray with @batch_dist_calculator
+        @dist_calculator: function to calculate distance between two data points
+        @kernel: optional function applied to distances, called on np.ndarrays
+        @batch_dist_calculator: optional function to calculate distances between
+        one data point and a stacked array of data points
+        @dtype: np.float32 or np.float64
+        @block_size: number of rows and columns of a block
+        @n_jobs: number of worker processes, -1: number of cpus
+        @write: function called with every (block, distances) as it is done
+    '''
+    global _matrix_args
+
+    if dist_calculator is None or not callable(dist_calculator):
+        raise Exception('a callable distance function is required')
+    if kernel is not None and not callable(kernel):
+        raise Exception('kernel must be callable')
+    if n_jobs < 0:
+        n_jobs = cpu_count()
+
+    _matrix_args = (data, dist_calculator, batch_dist_calculator, kernel, dtype)
+    pool = Pool(n_jobs) if n_jobs > 1 else None
+    try:
+        blocks = _blocks(len(data), block_size)
+        results = pool.imap_unordered(_block_dists, blocks) if pool is not None else map(_block_dists, blocks)
+        for block, dists in results:
+            write(block, dists)
+    finally:
+        if pool is not None:
+            pool.terminate()
+        _matrix_args = None
+
+def _diagonal(kernel):
+    '''
+        value of the diagonal, a zero distance under @kernel
+
+        @kernel: optional function applied to distances
+
+        #return: float
+    '''
+    return float(kernel(np.zeros(1))[0]) if kernel is not None else 0.0
+
+def dist_matrix(data, dist_calculator, kernel=None, batch_dist_calculator=None, dtype=np.float64,
+                path=None, block_size=256, n_jobs=1):
+    '''
+        calculate the symmetric matrix of distances between all pairs of data.
+        Blocks of the upper triangle are calculated in a pool of forked
+        processes and written to a preallocated matrix together with their
+        mirrors below the diagonal
+
+        @data: a list of data points, or a 2-d np.ndarray with @batch_dist_calculator
+        @dist_calculator: function to calculate distance between two data points
+        @kernel: optional function applied to distances, called on np.ndarrays
+        @batch_dist_calculator: optional function to calculate distances between
+        one data point and a stacked array of data points
+        @dtype: np.float32 or np.float64
+        @path: optional file, the matrix is a np.memmap on it
+        @block_size: number of rows and columns of a block
+        @n_jobs: number of worker processes, -1: number of cpus
+
+        #return: np.ndarray or np.memmap of shape (len(data), len(data))
+    '''
+    if batch_dist_calculator is not None:
+        data = np.asarray(data)
+
+    size = len(data)
+    if path is not None:
+        matrix = np.memmap(path, dtype=dtype, mode='w+', shape=(size, size))
+    else:
+        matrix = np.empty((size, size), dtype=dtype)
+    diagonal = _diagonal(kernel)
+
+    def write((i0, i1, j0, j1), dists):
+        matrix[i0:i1, j0:j1] = dists
+        if i0 != j0:
+            matrix[j0:j1, i0:i1] = dists.T
+        else:
+            # only the upper triangle of a diagonal block is calculated
+            upper = np.triu(dists, 1)
+            matrix[i0:i1, j0:j1] = upper + upper.T
+            np.fill_diagonal(matrix[i0:i1, j0:j1], diagonal)
+
+    _calculate_blocks(data, dist_calculator, kernel, batch_dist_calculator, dtype, block_size, n_jobs, write)
+    if path is not None:
+        matrix.flush()
+    return matrix
+
+def condensed_dist_matrix(data, dist_calculator, kernel=None, batch_dist_calculator=None, dtype=np.float64,
+                          path=None, block_size=256, n_jobs=1):
+    '''
+        calculate distances between all pairs of data like dist_matrix, but
+        keep only the upper triangle, in the layout of scipy.spatial.distance.pdist
+
+        @data: a list of data points, or a 2-d np.ndarray with @batch_dist_calculator
+        @dist_calculator: function to calculate distance between two data points
+        @kernel: optional function applied to distances, called on np.ndarrays
+        @batch_dist_calculator: optional function to calculate distances between
+        one data point and a stacked array of data points
+        @dtype: np.float32 or np.float64
+        @path: optional .npy file, the condensed array is a memmap on it which
+        CondensedDistMatrix.load opens again
+        @block_size: number of rows and columns of a block
+        @n_jobs: number of worker processes, -1: number of cpus
+
+        #return: a CondensedDistMatrix
+    '''
+    if batch_dist_calculator is not None:
+        data = np.asarray(data)
+
+    size = len(data)
+    length = size * (size-1) / 2
+    if path is not None:
+        condensed = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(length,))
+    else:
+        condensed = np.empty(length, dtype=dtype)
+
+    def write((i0, i1, j0, j1), dists):
+        for i in xrange(i0, i1):
+            start = max(j0, i+1)
+            if start < j1:
+                pos = _condensed_index(size, i, start)
+                condensed[pos:pos+j1-start] = dists[i-i0, start-j0:]
+
+    _calculate_blocks(data, dist_calculator, kernel, batch_dist_calculator, dtype, block_size, n_jobs, write)
+    if path is not None:
+        condensed.flush()
+    return CondensedDistMatrix(condensed, _diagonal(kernel))
+
+def _condensed_index(size, i, j):
+    '''
+        position of entry (i, j) of a square matrix in its condensed array
+
+        @size: number of rows
+        @i: row, i < j, an int or np.ndarray
+        @j: column
+
+        #return: int or np.ndarray
+    '''
+    return size*i - i*(i+1)/2 + j - i - 1
+
+def _tree_neighbours(rows):
+    '''
+        query neighbours of rows in a tree in a worker process
+
+        @rows: positions of data points to query
+
+        #return: (row positions, column positions, distances) of neighbours,
+        a data point is not its own neighbour
+    '''
+    data, tree, radius, k = _graph_args
+    graph_rows = []
+    graph_cols = []
+    graph_dists = []
+    for i in rows:
+        if k is None:
+            indices, dists = tree.range_query(data[i], radius)
+        else:
+            # the data point itself is found too, one more is asked for
+            indices, dists = tree.knn(data[i], k+1)
+        pairs = [ (j, d) for j, d in zip(indices, dists) if j != i ]
+        if k is not None:
+            pairs = pairs[:k]
+        graph_rows.extend([i] * len(pairs))
+        graph_cols.extend([ j for j, d in pairs ])
+        graph_dists.extend([ d for j, d in pairs ])
+    return (graph_rows, graph_cols, graph_dists)
+
+def neighbour_graph(data, dist_calculator, radius=None, k=None, tree=None, batch_dist_calculator=None,
+                    block_size=256, n_jobs=1):
+    '''
+        sparse graph of distances to near neighbours, a data point is not its
+        own neighbour. Neighbours are found by queries to @tree, or by
+        calculating blocks of distances like dist_matrix and keeping only the
+        neighbours, so memory is linear in the number of edges
+
+        @data: a list of data points, or a 2-d np.ndarray with @batch_dist_calculator
+        @dist_calculator: function to calculate distance between two data points
+        @radius: neighbours within a radius, symmetric
+        @k: or k nearest neighbours of every row, not symmetric
+        @tree: optional cover tree of @data, indices of values are positions in @data
+        @batch_dist_calculator: optional function to calculate distances between
+        one data point and a stacked array of data points
+        @block_size: number of rows and columns of a block, or rows of a tree query
+        @n_jobs: number of worker processes, -1: number of cpus
+
+        #return: scipy.sparse.csr_matrix of shape (len(data), len(data)), zero
+        distances of different data points are explicit entries
+    '''
+    global _graph_args
+
+    if (radius is None) == (k is None):
+        raise Exception('one of radius and k is required')
+    if batch_dist_calculator is not None:
+        data = np.asarray(data)
+    if n_jobs < 0:
+        n_jobs = cpu_count()
+
+    size = len(data)
+    graph_rows = []
+    graph_cols = []
+    graph_dists = []
+    if tree is not None:
+        _graph_args = (data, tree, radius, k)
+        pool = Pool(n_jobs) if n_jobs > 1 else None
+        try:
+            chunks = [ range(i, min(i+block_size, size)) for i in xrange(0, size, block_size) ]
+            results = pool.imap_unordered(_tree_neighbours, chunks) if pool is not None else map(_tree_neighbours, chunks)
+            for rows, cols, dists in results:
+                graph_rows.extend(rows)
+                graph_cols.extend(cols)
+                graph_dists.extend(dists)
+        finally:
+            if pool is not None:
+                pool.terminate()
+            _graph_args = None
+    elif radius is not None:
+        def write((i0, i1, j0, j1), dists):
+            rows, cols = np.nonzero(dists <= radius)
+            rows += i0
+            cols += j0
+            # only entries above the diagonal are calculated
+            upper = rows < cols
+            rows, cols = rows[upper], cols[upper]
+            values = dists[rows-i0, cols-j0]
+            graph_rows.extend([rows, cols])
+            graph_cols.extend([cols, rows])
+            graph_dists.extend([values, values])
+        _calculate_blocks(data, dist_calculator, None, batch_dist_calculator, np.float64, block_size, n_jobs, write)
+    else:
+        k = min(k, size-1)
+        best_dists = np.full((size, k), np.inf)
+        best_cols = np.full((size, k), -1, dtype=np.intp)
+        def merge(rows, cols, dists):
+            # keep the k nearest of known neighbours of @rows and new ones
+            merged_dists = np.hstack([best_dists[rows], dists])
+            merged_cols = np.hstack([best_cols[rows], np.tile(cols, (len(rows), 1))])
+            nearest = np.argsort(merged_dists, axis=1, kind='mergesort')[:, :k]
+            best_dists[rows] = np.take_along_axis(merged_dists, nearest, axis=1)
+            best_cols[rows] = np.take_along_axis(merged_cols, nearest, axis=1)
+        def write((i0, i1, j0, j1), dists):
+            if i0 == j0:
+                # only entries above the diagonal are calculated
+                dists = np.where(np.triu(np.ones(dists.shape, dtype=bool), 1), dists, np.inf)
+                dists = np.minimum(dists, dists.T)
+                np.fill_diagonal(dists, np.inf)
+            merge(np.arange(i0, i1), np.arange(j0, j1), dists)
+            if i0 != j0:
+                merge(np.arange(j0, j1), np.arange(i0, i1), dists.T)
+        _calculate_blocks(data, dist_calculator, None, batch_dist_calculator, np.float64, block_size, n_jobs, write)
+        if k > 0:
+            graph_rows = [np.repeat(np.arange(size), k)]
+            graph_cols = [best_cols.ravel()]
+            graph_dists = [best_dists.ravel()]
+
+    if 0 != len(graph_rows) and isinstance(graph_rows[0], np.ndarray):
+        graph_rows = np.concatenate(graph_rows)
+        graph_cols = np.concatenate(graph_cols)
+        graph_dists = np.concatenate(graph_dists)
+    graph = sparse.coo_matrix((np.asarray(graph_dists, dtype=np.float64),
+    (np.asarray(graph_rows, dtype=np.intp), np.asarray(graph_cols, dtype=np.intp))), shape=(size, size))
+    return graph.tocsr()
+
+class CondensedDistMatrix:
+
+    def __init__(self, condensed, diagonal=0.0):
+        '''
+            init function of CondensedDistMatrix, a symmetric matrix of which
+            only the upper triangle is kept. Rows are expanded to square form
+            block by block when they are needed
+
+            @condensed: np.ndarray or np.memmap, upper triangle in the layout of
+            scipy.spatial.distance.pdist
+            @diagonal: value of the diagonal
+        '''
+        self.condensed = condensed
+        self.diagonal = diagonal
+        self.size = int(round((1 + np.sqrt(1 + 8*len(condensed))) / 2))
+        if self.size * (self.size-1) / 2 != len(condensed):
+            raise Exception('length of a condensed matrix must be n*(n-1)/2')
+        self.shape = (self.size, self.size)
+        self.dtype = condensed.dtype
+
+    @classmethod
+    def load(cls, path, diagonal=0.0, mmap_mode='r'):
+        '''
+            open a matrix saved by condensed_dist_matrix without reading it
+
+            @path: .npy file
+            @diagonal: value of the diagonal
+            @mmap_mode: mmap_mode of np.load, None: read into memory
+
+            #return: a CondensedDistMatrix
+        '''
+        return cls(np.load(path, mmap_mode=mmap_mode), diagonal)
+
+    def rows(self, start, end):
+        '''
+            expand rows of the matrix to square form
+
+            @start: first row
+            @end: row after the last row
+
+            #return: np.ndarray of shape (end-start, size)
+        '''
+        size = self.size
+        block = np.empty((end-start, size), dtype=self.dtype)
+        for r, i in enumerate(xrange(start, end)):
+            # column i of rows above i, then the row itself after the diagonal
+            above = np.arange(i)
+            block[r, :i] = self.condensed[_condensed_index(size, above, i)]
+            block[r, i] = self.diagonal
+            pos = _condensed_index(size, i, i+1)
+            block[r, i+1:] = self.condensed[pos:pos+size-i-1]
+        return block
+
+    def iter_rows(self, block_size=1024):
+        '''
+            expand rows of the matrix block by block
+
+            @block_size: number of rows of a block
+
+            #return: a generator of (first row, np.ndarray of rows)
+        '''
+        for start in xrange(0, self.size, block_size):
+            yield (start, self.rows(start, min(start+block_size, self.size)))
+
+    def to_square(self, path=None, block_size=1024):
+        '''
+            expand the whole matrix, for estimators which need square form
+
+            @path: optional file, the matrix is a np.memmap on it
+            @block_size: number of rows expanded at once
+
+            #return: np.ndarray or np.memmap of shape (size, size)
+        '''
+        if path is not None:
+            matrix = np.memmap(path, dtype=self.dtype, mode='w+', shape=self.shape)
+        else:
+            matrix = np.empty(self.shape, dtype=self.dtype)
+        for start, block in self.iter_rows(block_size):
+            matrix[start:start+len(block)] = block
+        return matrix
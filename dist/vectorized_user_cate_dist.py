@@ -3,8 +3,12 @@
 import sys
 sys.path.append(sys.path[0] + '/../')
 from data_loader.data_loader import DataLoader
+from multiprocessing import Pool, cpu_count
 import numpy as np
 
+# (uids, user_bus_dict, bus_ids, pivots, sigma) shared with forked chunk workers
+_vectorize_args = None
+
 class CateTreeNode:
 
     def __init__(self, label, parent):
@@ -113,13 +117,91 @@ class CateTree:
         return sum_similarity
 
 
+class CompiledPivots:
+
+    def __init__(self, pivots):
+        '''
+            init function of CompiledPivots, which flattens a list of CateTree
+            pivots into arrays, so similarities of a user to all pivots are
+            calculated at once. Every node of a pivot gets an id, its path is
+            hashed to the id, and its weight is the similarity CateTree.similarity
+            gives to a path ending at it: the product of
+            1/(len(chd_set)+bus_share) along the path and 1/bus_cnt of the node.
+            Pivots changed after compiling are not seen
+
+            @pivots: a list of CateTree
+        '''
+        if type(pivots) != list:
+            raise Exception('pivots must be a list of CateTree')
+
+        self.pivots = pivots
+        self.size = len(pivots)
+        # path => ids of nodes at the end of the path, one for every pivot containing it
+        self.path_ids = {}
+        weights = []
+        pivot_of_ids = []
+        for d, t in enumerate(pivots):
+            if t.__class__ != CateTree:
+                raise Exception('the %d-th pivot not a CateTree' % d)
+            # an empty path is found at the root without weights
+            stack = [ (t.root, (), 1.0) ]
+            while 0 != len(stack):
+                node, path, weight = stack.pop()
+                if node is not t.root:
+                    bus_share = 0.0 if node.bus_cnt==0 else 1.0
+                    weight *= 1.0/(len(node.chd_set) + bus_share)
+                # a path ending at a node of no business can not be weighted
+                end_weight = 1.0 if node is t.root else (weight*(1.0/node.bus_cnt) if node.bus_cnt!=0 else np.nan)
+                self.path_ids.setdefault(path, []).append(len(weights))
+                weights.append(end_weight)
+                pivot_of_ids.append(d)
+                for chd in node.chd_set:
+                    stack.append((chd, path + (chd.label,), weight))
+        self.weights = np.array(weights)
+        self.pivot_of_ids = np.array(pivot_of_ids, dtype=np.intp)
+
+    def node_ids(self, path_set):
+        '''
+            find ids of nodes at the end of paths
+
+            @path_set: a set of paths, [ [<path_1>], [<path_2>], ...]
+
+            #return: np.ndarray of ids, paths not in any pivot are left out
+        '''
+        ids = []
+        for path in path_set:
+            path_ids = self.path_ids.get(tuple(path))
+            if path_ids is not None:
+                ids.extend(path_ids)
+        return np.array(ids, dtype=np.intp)
+
+    def similarities(self, path_set):
+        '''
+            calculate similarities between a user and every pivot, equal to
+            CateTree.similarity of every pivot
+
+            @path_set: a set of paths, [ [<path_1>], [<path_2>], ...]
+
+            #return: np.ndarray, shape: [number of pivots]
+        '''
+        if type(path_set)!=list:
+            raise Exception('path_set must be list')
+
+        ids = self.node_ids(path_set)
+        similarities = np.bincount(self.pivot_of_ids[ids], weights=self.weights[ids], minlength=self.size)
+        if np.isnan(similarities).any():
+            raise Exception('a path ends at a category of no business')
+        return similarities
+
+
 def vectorized_convertor(uid, bus_cate_dict, kwargs):
     '''
         convert a user's category data to data a vector
 
         @uid: user id
         @bus_cate_dict: a dict whose keys are business ids and values are category paths
-        @kwargs: a dict of other parameter, {'pivots':[], 'sigma': val} 
+        @kwargs: a dict of other parameter, {'pivots':[], 'sigma': val}, pivots
+        is a list of CateTree or a CompiledPivots
 
         #return: feature vector
     '''
@@ -128,8 +210,14 @@ def vectorized_convertor(uid, bus_cate_dict, kwargs):
         raise Exception('bus_cate_dict must be a dict')
 
     pivots = kwargs['pivots']
-    if type(pivots) != list:
-        raise Exception('pivots in kwargs must be a list of CateTree')
+    if pivots.__class__ != CompiledPivots:
+        if type(pivots) != list:
+            raise Exception('pivots in kwargs must be a list of CateTree')
+        # pivots are compiled by the first call and kept in kwargs, which
+        # DataLoader.load passes to every call
+        if not kwargs.has_key('compiled_pivots') or kwargs['compiled_pivots'].pivots is not pivots:
+            kwargs['compiled_pivots'] = CompiledPivots(pivots)
+        pivots = kwargs['compiled_pivots']
     try:
         sigma = kwargs['sigma']
     except Exception, e:
@@ -141,26 +229,104 @@ def vectorized_convertor(uid, bus_cate_dict, kwargs):
     else:
         mean = None
 
-    feature_arr = [0.0 for i in xrange(len(pivots))]
     path_sets = []
     for key in bus_cate_dict.keys():
         for p in bus_cate_dict[key]:
             path_sets.append(p)
-    for d in xrange(len(pivots)):
-        t = pivots[d]
-        if t.__class__ != CateTree:
-            raise Exception('the %d-th pivot not a CateTree' % d)
-        feature_arr[d] = t.similarity(path_sets)
-        if sigma != 0.:
-            if type(sigma) == list:
-                s = sigma[d]
-            else:
-                s = sigma
-            u = t.similarity(path_sets)
-            feature_arr[d] = np.exp(-np.power(u, 2)/(2.0*np.power(s, 2)))
-
-    feature_arr = np.array(feature_arr)
-    return feature_arr
+    return _sigma_feature(pivots.similarities(path_sets), sigma)
+
+def _sigma_feature(similarities, sigma):
+    '''
+        apply sigma of vectorized_convertor to similarities
+
+        @similarities: np.ndarray, similarities to pivots in the last axis
+        @sigma: a float, an int or a list of one sigma per pivot
+
+        #return: np.ndarray
+    '''
+    if type(sigma) != float and type(sigma)!=int and type(sigma)!=list:
+        raise Exception('sigma must be a float or an int or an list')
+    if type(sigma) == list or sigma != 0.:
+        s = np.array(sigma, dtype=float)
+        return np.exp(-np.power(similarities, 2)/(2.0*np.power(s, 2)))
+    return similarities
+
+def _vectorize_chunk((start, end)):
+    '''
+        calculate features of a chunk of users in a worker process, all
+        similarities of the chunk are summed by one np.bincount
+
+        @start: first row
+        @end: row after the last row
+
+        #return: (@start, np.ndarray of shape (end-start, number of pivots))
+    '''
+    uids, user_bus_dict, bus_ids, pivots, sigma = _vectorize_args
+    ids = []
+    for uid in uids[start:end]:
+        # a business reviewed twice counts once, as in DataLoader.load
+        ids.append(np.concatenate([np.array([], dtype=np.intp)] + [ bus_ids[bid] for bid in set(user_bus_dict[uid]) ]))
+    rows = np.repeat(np.arange(end-start), [ len(i) for i in ids ])
+    ids = np.concatenate(ids) if 0 != len(ids) else np.array([], dtype=np.intp)
+    similarities = np.bincount(rows*pivots.size + pivots.pivot_of_ids[ids], weights=pivots.weights[ids],
+    minlength=(end-start)*pivots.size).reshape((end-start, pivots.size))
+    if np.isnan(similarities).any():
+        raise Exception('a path ends at a category of no business')
+    return (start, _sigma_feature(similarities, sigma))
+
+def batch_vectorized_convertor(user_bus_dict, bus_cate_dict, pivots, uids=None, sigma=0., mean=None,
+                               out=None, chunk_size=4096, n_jobs=1):
+    '''
+        convert many users to feature vectors of vectorized_convertor at
+        once. Paths of every business are mapped to compiled pivots once,
+        and chunks of users are calculated in a pool of forked processes
+        and written to one matrix
+
+        @user_bus_dict: a dict whose keys are user ids and values are lists of business ids
+        @bus_cate_dict: a dict whose keys are business ids and values are category paths
+        @pivots: a CompiledPivots or a list of CateTree
+        @uids: user ids of rows, default: keys of @user_bus_dict
+        @sigma: a float, an int or a list of one sigma per pivot, see vectorized_convertor
+        @mean: accepted as by vectorized_convertor, which does not use it
+        @out: optional preallocated matrix, e.g. a np.memmap, of shape
+        (len(@uids), number of pivots)
+        @chunk_size: number of users of a chunk
+        @n_jobs: number of worker processes, -1: number of cpus
+
+        #return: a float32 np.ndarray, or @out, of shape (len(@uids), number of pivots)
+    '''
+    global _vectorize_args
+
+    if pivots.__class__ != CompiledPivots:
+        pivots = CompiledPivots(pivots)
+    if uids is None:
+        uids = user_bus_dict.keys()
+    if n_jobs < 0:
+        n_jobs = cpu_count()
+    if out is None:
+        out = np.empty((len(uids), pivots.size), dtype=np.float32)
+    elif out.shape != (len(uids), pivots.size):
+        raise Exception('out must be of shape (number of users, number of pivots)')
+    _sigma_feature(np.zeros(pivots.size), sigma)
+
+    bus_ids = {}
+    for uid in uids:
+        for bid in user_bus_dict[uid]:
+            if not bus_ids.has_key(bid):
+                bus_ids[bid] = pivots.node_ids(bus_cate_dict[bid])
+
+    _vectorize_args = (uids, user_bus_dict, bus_ids, pivots, sigma)
+    pool = Pool(n_jobs) if n_jobs > 1 else None
+    try:
+        chunks = [ (i, min(i+chunk_size, len(uids))) for i in xrange(0, len(uids), chunk_size) ]
+        results = pool.imap_unordered(_vectorize_chunk, chunks) if pool is not None else map(_vectorize_chunk, chunks)
+        for start, features in results:
+            out[start:start+len(features)] = features
+    finally:
+        if pool is not None:
+            pool.terminate()
+        _vectorize_args = None
+    return out
 
 def vectorized_dist_calculator(v_1, v_2):
     '''
@@ -178,6 +344,22 @@ def vectorized_dist_calculator(v_1, v_2):
 
     return np.sqrt(np.sum(np.square(v_1-v_2)))
 
+def vectorized_batch_dist_calculator(v, v_set):
+    '''
+        calculate distances between v and every row of v_set in one call
+        @v: np.ndarray, shape: [n_features]
+        @v_set: np.ndarray, shape: [n_samples, n_features]
+
+        #return: np.ndarray, shape: [n_samples], distance values
+    '''
+    if type(v)!=np.ndarray or type(v_set)!=np.ndarray:
+        raise Exception('parameters must be np.ndarray')
+
+    if np.ndim(v_set) != 2 or np.shape(v_set)[1:] != np.shape(v):
+        raise Exception('every row of v_set must share a common shape with v')
+
+    return np.sqrt(np.sum(np.square(v_set-v), axis=1))
+
 
 def generate_category_tree(data_loader):
     '''
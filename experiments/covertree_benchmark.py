@@ -0,0 +1,96 @@
+#coding:utf-8
+'''
+    benchmark of cover tree insert and density estimation against level width.
+    Random vectors are inserted into a DensityCoverTree with a fixed top level,
+    the width of the bottom level grows with the size of data.
+
+    Densities are estimated for nodes of the level in the middle of level stack.
+    With --rev the cover tree of a git revision is benchmarked instead of the
+    working tree, so runs before and after a change can be compared.
+
+    usage: python covertree_benchmark.py [--rev revision] [size_1 size_2 ...]
+'''
+
+import sys
+sys.path.append(sys.path[0] + '/../')
+import numpy as np
+import time
+import os
+import subprocess
+import tempfile
+import shutil
+
+def eul_dist(a, b):
+    return np.sqrt(np.sum(np.square(a-b)))
+
+def batch_eul_dist(a, b_set):
+    return np.sqrt(np.sum(np.square(b_set-a), axis=1))
+
+def checkout(rev):
+    '''
+        extract the files of a git revision of this repository
+
+        @rev: a git revision, e.g. HEAD~1
+
+        #return: path of a temporary directory holding the files
+    '''
+    path = tempfile.mkdtemp()
+    archive = subprocess.Popen(['git', 'archive', rev], stdout=subprocess.PIPE,
+    cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    extract = subprocess.Popen(['tar', '-x', '-C', path], stdin=archive.stdout)
+    archive.stdout.close()
+    if 0 != extract.wait() or 0 != archive.wait():
+        shutil.rmtree(path)
+        raise Exception('can not extract revision %s' % rev)
+    return path
+
+def benchmark(data_size, n_features=4, top_level=1, density_samples=200):
+    '''
+        insert random vectors and estimate densities of nodes in the middle level
+
+        @data_size: number of vectors
+        @n_features: dimension of vectors
+        @top_level: level of root
+        @density_samples: number of nodes to estimate density
+
+        #return: (bottom level width, middle level width, insert seconds per node,
+        density seconds per node)
+    '''
+    # imported on first use, from the revision given by --rev if any
+    from covertree.node import Node
+    from ctc.density_covertree import DensityCoverTree
+
+    rng = np.random.RandomState(0)
+    data = rng.rand(data_size, n_features)
+    dct = DensityCoverTree(eul_dist, top_level, batch_eul_dist)
+
+    start_time = time.time()
+    for i, d in enumerate(data):
+        dct.insert(Node(val=d, index=i))
+    insert_time = (time.time() - start_time) / data_size
+
+    middle_level = dct.level_stack[len(dct.level_stack)/2]
+    samples = [ middle_level[i] for i in rng.permutation(len(middle_level))[:density_samples] ]
+    start_time = time.time()
+    for n in samples:
+        dct.estimate_density(n)
+    density_time = (time.time() - start_time) / len(samples)
+
+    return (len(dct.level_stack[-1]), len(middle_level), insert_time, density_time)
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    rev_path = None
+    if 0 != len(args) and args[0] == '--rev':
+        rev_path = checkout(args[1])
+        sys.path.insert(0, rev_path)
+        args = args[2:]
+    sizes = [ int(s) for s in args ] if len(args) > 0 else [1000, 2000, 4000, 8000, 16000]
+    try:
+        print 'size\tbottom width\tmiddle width\tinsert ms/node\tdensity ms/node'
+        for size in sizes:
+            bottom_width, middle_width, insert_time, density_time = benchmark(size)
+            print '%d\t%d\t%d\t%.3f\t%.3f' % (size, bottom_width, middle_width, insert_time*1000, density_time*1000)
+    finally:
+        if rev_path is not None:
+            shutil.rmtree(rev_path)
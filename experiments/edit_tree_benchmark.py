@@ -0,0 +1,64 @@
+#coding:utf-8
+'''
+    benchmark of converting users to BUEditTrees against number of reviews.
+    A synthetic category hierarchy is generated, every review of a heavy user
+    is a business with a few category paths ending with the business id.
+
+    usage: python edit_tree_benchmark.py [reviews_1 reviews_2 ...]
+'''
+
+import sys
+sys.path.append(sys.path[0] + '/../')
+from dist.bottom_up_edit_dist import bottomup_edit_dist_converter
+import numpy as np
+import time
+
+def synthetic_user(n_reviews, rng, fanout=8, depth=3, max_cates=3):
+    '''
+        generate a dict of businesses of a user
+
+        @n_reviews: number of businesses
+        @rng: a numpy RandomState
+        @fanout: number of children of a category
+        @depth: max depth of category paths
+        @max_cates: max number of category paths of a business
+
+        #return: a dict whose keys are business ids and values are category paths
+    '''
+    bus_cate_dict = {}
+    for b in xrange(n_reviews):
+        bid = 'b%d' % b
+        paths = []
+        for c in xrange(rng.randint(1, max_cates+1)):
+            path = [ 'c%d' % rng.randint(fanout) ]
+            for d in xrange(rng.randint(0, depth)):
+                path.append('%s.%d' % (path[-1], rng.randint(fanout)))
+            paths.append(path + [bid])
+        bus_cate_dict[bid] = paths
+    return bus_cate_dict
+
+def benchmark(n_reviews, n_users=5):
+    '''
+        convert synthetic users with a number of reviews
+
+        @n_reviews: number of reviews of every user
+        @n_users: number of users
+
+        #return: (nodes per tree, seconds per user, seconds per path)
+    '''
+    rng = np.random.RandomState(0)
+    users = [ synthetic_user(n_reviews, rng) for u in xrange(n_users) ]
+    n_paths = sum([ len(ps) for user in users for ps in user.values() ])
+
+    start_time = time.time()
+    trees = [ bottomup_edit_dist_converter('u%d' % u, user, {}) for u, user in enumerate(users) ]
+    convert_time = time.time() - start_time
+
+    return (sum([ t.size for t in trees ]) / n_users, convert_time / n_users, convert_time / n_paths)
+
+if __name__ == '__main__':
+    sizes = [ int(s) for s in sys.argv[1:] ] if len(sys.argv) > 1 else [100, 1000, 4000, 16000]
+    print 'reviews\tnodes\tms/user\tus/path'
+    for size in sizes:
+        nodes, user_time, path_time = benchmark(size)
+        print '%d\t%d\t%.1f\t%.1f' % (size, nodes, user_time*1000, path_time*1000000)
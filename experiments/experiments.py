@@ -8,6 +8,9 @@ from dist.bottom_up_edit_dist import *
 from dist.vectorized_user_cate_dist import *
 from ctc.density_covertree import *
 from ctc.covertree_clustering import *
+from covertree.sharded_build import build_sharded
+from dist.dist_matrix import dist_matrix, condensed_dist_matrix, CondensedDistMatrix, neighbour_graph
+from scipy.cluster.hierarchy import linkage, cut_tree
 import time
 import logging
 import numpy as np
@@ -27,49 +30,134 @@ vec_X = None
 edit_data = None
 edit_spec_X = None
 edit_X = None
+# key of edit_X, of dataset and data size as in its file name
+edit_X_key = None
+edit_graphs = {}
+covertree_sessions = {}
 
 
-def _data_format(data, precomputed=False, dist_func=None, kernal=lambda x:x):
+def _data_format(data, precomputed=False, dist_func=None, kernal=lambda x:x, batch_dist_func=None):
     '''
         format data to numpy
 
         @data: list, each element is a data point
         @precomputed: boolean, False:not precomputed; True:precomputed
-        @kernal: callable, kernal function
+        @dist_func: callable, distance function
+        @kernal: callable, kernal function, called on blocks of distances
+        @batch_dist_func: optional callable, distances between one data point
+        and a stacked array of data points
 
         #return: if precomputed => a square matrix; else => feature vec ndarray
     '''
     if not precomputed:
         return np.array(data)
-    
-    if dist_func is None or not callable(dist_func):
-        raise Exception('a callable distance function is required')
 
-    if kernal is not None and not callable(kernal):
-        raise Exception('kernal must be callable')
-    
+    # blocks of the matrix are calculated by n_jobs processes
+    n_jobs = config['n_jobs'] if config.has_key('n_jobs') else 1
+    return dist_matrix(data, dist_func, kernal, batch_dist_func, n_jobs=n_jobs)
 
-    dist_matrix = np.array(
-        [
-            [ 0.0 for i in xrange(len(data))] for j in xrange(len(data))
-        ]
-    )
-    for i in xrange(len(data)):
-        for j in xrange(i, len(data)):
-            if i==j:
-                dist_matrix[i,j] = kernal(0.0)
-            else:
-                dist_matrix[i,j] = kernal(dist_func(data[i], data[j]))
-                dist_matrix[j,i] = dist_matrix[i,j]
-    
-    return dist_matrix
+def _condensed_format(data, dist_func, kernal, key):
+    '''
+        format data to a condensed matrix of distances. With dist_matrix_path
+        in config the matrix is a memmap on a file named by @key, which later
+        runs on the same data open again
+
+        @data: list, each element is a data point
+        @dist_func: callable, distance function
+        @kernal: None or callable, kernal function, called on blocks of distances
+        @key: string, name of the matrix, of dataset, distance and kernal
+
+        #return: CondensedDistMatrix
+    '''
+    n_jobs = config['n_jobs'] if config.has_key('n_jobs') else 1
+    matrix_path = config['dist_matrix_path'] if config.has_key('dist_matrix_path') else None
+    if matrix_path is None:
+        return condensed_dist_matrix(data, dist_func, kernal, n_jobs=n_jobs)
+
+    path = os.path.join(matrix_path, '%s_%d.npy' % (key, len(data)))
+    if os.path.isfile(path):
+        return CondensedDistMatrix.load(path, kernal(0.0) if kernal is not None else 0.0)
+    if not os.path.isdir(matrix_path):
+        os.makedirs(matrix_path)
+    # a matrix left by an interrupted run is never opened
+    X = condensed_dist_matrix(data, dist_func, kernal, path=path + '.part', n_jobs=n_jobs)
+    os.rename(path + '.part', path)
+    return X
+
+def _graph_format(data, alg):
+    '''
+        format edit trees to a sparse graph of near neighbours found by a
+        cover tree: neighbours within eps for dbscan, rbf affinities of
+        n_neighbors nearest neighbours for spectral
+
+        @data: list, edit trees
+        @alg: string, in ['dbscan', 'spectral']
+
+        #return: scipy.sparse.csr_matrix
+    '''
+    n_jobs = config['n_jobs'] if config.has_key('n_jobs') else 1
+    # the tree of a covertree session of the same data is reused
+    session_key = ('edit', len(data))
+    if covertree_sessions.has_key(session_key):
+        tree = covertree_sessions[session_key].dct
+    else:
+        tree = CompactDensityCoverTree.build(data, bottomup_edit_dist_calculator, config['edit_top_level'])
+
+    if alg == 'dbscan':
+        return neighbour_graph(data, bottomup_edit_dist_calculator, radius=config['eps'], tree=tree, n_jobs=n_jobs)
+    n_neighbors = config['n_neighbors'] if config.has_key('n_neighbors') else 10
+    graph = neighbour_graph(data, bottomup_edit_dist_calculator, k=n_neighbors, tree=tree, n_jobs=n_jobs)
+    graph.data = rbf(graph.data)
+    # an affinity is kept when either of two users is a neighbour of the other
+    return graph.maximum(graph.T).tocsr()
+
+def _square_format(X):
+    '''
+        expand a condensed matrix for sklearn estimators which need square form
+
+        @X: CondensedDistMatrix or ndarray
+
+        #return: ndarray
+    '''
+    return X.to_square() if X.__class__ == CondensedDistMatrix else X
+
+def _silhouette_score(X, labels, block_size=1024):
+    '''
+        silhouette score of a condensed matrix of distances as
+        sklearn.metrics.silhouette_score, rows are expanded block by block
+
+        @X: CondensedDistMatrix
+        @labels: ndarray, shape(X.size,), labels of data
+        @block_size: number of rows expanded at once
+
+        #return: float
+    '''
+    label_values, labels = np.unique(labels, return_inverse=True)
+    if not 1 < len(label_values) < X.size:
+        raise Exception('number of labels is %d, valid values are 2 to n_samples - 1' % len(label_values))
+    label_freqs = np.bincount(labels)
+    samples = np.arange(X.size)
+    members = np.zeros((X.size, len(label_values)))
+    members[samples, labels] = 1.0
+    # sums of distances from every data point to every cluster
+    sums = np.zeros((X.size, len(label_values)))
+    for start, rows in X.iter_rows(block_size):
+        sums[start:start+len(rows)] = rows.dot(members)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        intra = sums[samples, labels] / (label_freqs[labels] - 1)
+        means = sums / label_freqs
+        means[samples, labels] = np.inf
+        inter = means.min(axis=1)
+        sil_samples = (inter - intra) / np.maximum(intra, inter)
+    # nan values are for clusters of size 1, and should be 0
+    return np.mean(np.nan_to_num(sil_samples))
 
 def rbf(dist):
     '''
         Gaussian rbf kernal function
         formula: np.exp(- (d(X,X)**2)/(2 * sigma**2 ))
 
-        @dist: float
+        @dist: float or ndarray of distances
     '''
     #parameter modified here#
     sigma = config['rbf_sigma']
@@ -97,6 +185,9 @@ def algorithm_runner(alg, dist, **kwargs):
     global edit_data
     global edit_spec_X
     global edit_X
+    global edit_X_key
+    global edit_graphs
+    global covertree_sessions
 
     #start
     start_time = time.time()
@@ -107,6 +198,8 @@ def algorithm_runner(alg, dist, **kwargs):
         raise Exception('valid_uid must be a list')
     #data size
     data_size = float('inf') if not kwargs.has_key('data_size') else kwargs['data_size']
+    #dataset name, a key of saved distance matrices
+    dataset = 'data' if not kwargs.has_key('dataset') else kwargs['dataset']
 
     #load data based on dist type
     if dist == 'vec':
@@ -116,7 +209,11 @@ def algorithm_runner(alg, dist, **kwargs):
         mean = config['mean']
         pivots = generate_category_tree(data_loader)
         if vec_data is None and sys.argv[1] != 'efficiency':
-            vec_data = data_loader.load(vectorized_convertor, pivots=pivots,sigma=sigma, valid_uid=valid_uid, mean=mean, data_size = data_size)
+            # users are vectorized in chunks by n_jobs processes into one float32 matrix
+            n_jobs = config['n_jobs'] if config.has_key('n_jobs') else 1
+            uids, user_bus_dict, bus_cate_dict = data_loader.load_users(valid_uid=valid_uid, data_size=data_size)
+            vec_data = batch_vectorized_convertor(user_bus_dict, bus_cate_dict, CompiledPivots(pivots), uids,
+            sigma=sigma, mean=mean, n_jobs=n_jobs)
             vec_X = _data_format(vec_data, False, vectorized_dist_calculator)
             # print vec_X
         data = vec_data
@@ -127,15 +224,21 @@ def algorithm_runner(alg, dist, **kwargs):
             edit_data = data_loader.load(bottomup_edit_dist_converter, valid_uid=valid_uid, data_size = data_size)
         data = edit_data
         metric = 'precomputed' 
-        if alg == 'spectral':
+        use_graph = config['neighbour_graph'] if config.has_key('neighbour_graph') else False
+        if use_graph and alg in ['dbscan', 'spectral']:
+            if not edit_graphs.has_key(alg) and sys.argv[1] != 'efficiency':
+                edit_graphs[alg] = _graph_format(data, alg)
+            X = edit_graphs[alg] if edit_graphs.has_key(alg) else None
+        elif alg == 'spectral':
             kernal = rbf
             if edit_spec_X is None and sys.argv[1] != 'efficiency':
-                edit_spec_X = _data_format(data, True, bottomup_edit_dist_calculator, kernal=kernal)
+                edit_spec_X = _condensed_format(data, bottomup_edit_dist_calculator, kernal,
+                '%s_edit_rbf%g' % (dataset, config['rbf_sigma']))
             X = edit_spec_X
         else:
-            kernal = lambda x:x
             if edit_X is None and sys.argv[1] != 'efficiency':
-                edit_X = _data_format(data, True, bottomup_edit_dist_calculator, kernal=kernal)
+                edit_X = _condensed_format(data, bottomup_edit_dist_calculator, None, '%s_edit' % dataset)
+                edit_X_key = '%s_edit_%d' % (dataset, len(data))
             X = edit_X
 
     #dbscan
@@ -145,7 +248,7 @@ def algorithm_runner(alg, dist, **kwargs):
         eps = config['eps']
         min_samples = config['min_samples']
         dbscan = DBSCAN(eps=eps, min_samples=min_samples, metric=metric)
-        labels = dbscan.fit_predict(X)
+        labels = dbscan.fit_predict(_square_format(X))
         
     
     if not kwargs.has_key('k'):
@@ -163,7 +266,7 @@ def algorithm_runner(alg, dist, **kwargs):
     if alg == 'spectral':
         try:
             affinity = 'precomputed' if dist=='edit' else 'rbf'
-            labels = SpectralClustering(affinity=affinity, n_clusters=k).fit_predict(X)
+            labels = SpectralClustering(affinity=affinity, n_clusters=k).fit_predict(_square_format(X))
         except Exception,e:
             # logging.debug(e.message + " [exception, location: alg:%s; k-%d; dist:%s]"%(alg, k, dist))
             return (-1, -1, -1)
@@ -171,17 +274,42 @@ def algorithm_runner(alg, dist, **kwargs):
     
     #hierarchical
     if alg == 'hierarchical':
-        labels = AgglomerativeClustering(n_clusters=k, affinity=metric, linkage='average').fit_predict(X)
+        if X.__class__ == CondensedDistMatrix:
+            # AgglomerativeClustering condenses a precomputed matrix for
+            # scipy anyway, so the condensed matrix is cut directly
+            labels = cut_tree(linkage(X.condensed, method='average'), n_clusters=k).ravel()
+        else:
+            labels = AgglomerativeClustering(n_clusters=k, affinity=metric, linkage='average').fit_predict(X)
     
     #covertree
     if alg == 'covertree':
-        calculator = vectorized_dist_calculator if dist=='vec' else bottomup_edit_dist_calculator
+        # the tree and its densities are shared by every k of a dataset,
+        # named by dataset, distance and its parameters, top level and size
         top_level = (config['edit_top_level'] if dist=='edit' else config['vec_top_level']) 
-        dct = DensityCoverTree(calculator, top_level)
-	
-        for i, d in enumerate(data):
-	        dct.insert(Node(val=d, index=i))
-        labels = covertree_clustering(dct, k)
+        dist_key = ('%s_edit' % dataset) if dist=='edit' else ('%s_vec_sigma%g' % (dataset, config['sigma']))
+        session_key = '%s_top%s_%d' % (dist_key, top_level, len(data))
+        if not covertree_sessions.has_key(session_key):
+            calculator = vectorized_dist_calculator if dist=='vec' else bottomup_edit_dist_calculator
+            batch_calculator = vectorized_batch_dist_calculator if dist=='vec' else None
+            # a tree saved by an earlier run on the same data is reopened
+            snapshot_path = config['covertree_snapshot_path'] if config.has_key('covertree_snapshot_path') else None
+            if snapshot_path is not None:
+                snapshot_path = os.path.join(snapshot_path, session_key)
+            n_jobs = config['n_jobs'] if config.has_key('n_jobs') else 1
+            if snapshot_path is not None and os.path.isdir(snapshot_path):
+                dct = CompactDensityCoverTree.load(snapshot_path, calculator, batch_calculator)
+            elif n_jobs != 1:
+                # shards of near users are built in parallel and merged
+                dct = CompactDensityCoverTree.from_tree(build_sharded(DensityCoverTree, data, calculator,
+                top_level, batch_calculator, n_jobs=n_jobs))
+            else:
+                dct = CompactDensityCoverTree.build(data, calculator, top_level, batch_calculator)
+            if snapshot_path is not None and not os.path.isdir(snapshot_path):
+                dct.save(snapshot_path)
+            # densities are estimated within a relative error when configured
+            max_error = config['density_max_error'] if config.has_key('density_max_error') else None
+            covertree_sessions[session_key] = ClusteringSession(dct, n_jobs, max_error=max_error)
+        labels = covertree_sessions[session_key].cluster(k)
 
     #end
     end_time = time.time()
@@ -189,7 +317,7 @@ def algorithm_runner(alg, dist, **kwargs):
     #print alg
     return (data, labels, end_time-start_time)
 
-def index(data, y_predict, index_name, dist_name, y_truth = None):
+def index(data, y_predict, index_name, dist_name, y_truth = None, dataset = 'data'):
     '''
         index to evaluate the experiment result
 
@@ -198,6 +326,7 @@ def index(data, y_predict, index_name, dist_name, y_truth = None):
         @index_name: index to evaluate results, in ['sc', 'mae', 'rand']
         @dist_name: name of dist, in ['vec', 'edit']
         @y_truth: ndarray, shape(len(data),), truth
+        @dataset: string, dataset name, a key of saved distance matrices
         return: float
     '''
     if index_name not in ['sc', 'mae', 'rand', 'mse']:
@@ -239,13 +368,14 @@ def index(data, y_predict, index_name, dist_name, y_truth = None):
 
     elif index_name == 'sc':
         if dist_name == 'vec':
-            precomputed = False
-            metric = 'euclidean'
+            X = _data_format(data)
+            return silhouette_score(X, y_predict, metric='euclidean')
+        # the matrix of algorithm_runner is reused when it is of the same dataset
+        if edit_X is not None and edit_X_key == '%s_edit_%d' % (dataset, len(data)):
+            X = edit_X
         else:
-            precomputed = True
-            metric = 'precomputed'
-        X = _data_format(data, precomputed=precomputed, dist_func=dist)
-        return silhouette_score(X, y_predict, metric=metric)
+            X = _condensed_format(data, dist, None, '%s_edit' % dataset)
+        return _silhouette_score(X, y_predict)
     else:
         if y_truth is None and y_predict is not None:
             raise Exception('rand index requires y_truth')
@@ -295,7 +425,7 @@ def quality_experiments(dataset_name, k, algs=None, dists=None):
         for dist in dists:
             if alg=='kmeans' and dist=='edit':
                 continue
-            data, labels, run_time = algorithm_runner(alg, dist, valid_uid=valid_uid, k=k)
+            data, labels, run_time = algorithm_runner(alg, dist, valid_uid=valid_uid, k=k, dataset=dataset_name)
             if -1 == data and labels == -1 and run_time == -1:
                 logging.debug("in dataset:%s"%dataset_name)
                 continue
@@ -313,7 +443,7 @@ def quality_experiments(dataset_name, k, algs=None, dists=None):
             for idx in indexs:
                 if dataset_name.find('randomdata')>=0 and idx=='rand':
                     continue
-                index_val = index(data, labels, idx, dist, y_truth)
+                index_val = index(data, labels, idx, dist, y_truth, dataset_name)
                 log_content += '%s:%s; '%(idx, str(index_val))
             #size of clusters
             log_content += 'size: [ '
@@ -375,6 +505,9 @@ elif sys.argv[1] == 'quality':
         edit_data = None
         edit_spec_X = None
         edit_X = None
+        edit_X_key = None
+        edit_graphs = {}
+        covertree_sessions = {}
         
 elif sys.argv[1] == 'efficiency':
 
@@ -6,26 +6,93 @@ import unittest
 from covertree.covertree import CoverTree
 from covertree.node import Node
 from ctc.density_covertree import DensityCoverTree
+from ctc.compact_density_covertree import CompactDensityCoverTree
+from covertree.sharded_build import build_sharded
+from dist.vectorized_user_cate_dist import vectorized_dist_calculator, vectorized_batch_dist_calculator
+from ctc.covertree_clustering import covertree_clustering, estimate_densities, estimate_density_bounds, assign_labels, ClusteringSession, OnlineClustering, _to_labels
 import numpy as np
+import tempfile
+import shutil
 
 def eul_dist(a,b):
     return np.sqrt(np.sum(np.square(a-b))) 
 
+def bounded_eul_dist(a, b, upper_bound=None):
+    #far values only get a value above the bound, as a lower bound would
+    d = eul_dist(a, b)
+    if upper_bound is not None and d > upper_bound:
+        return upper_bound + 1
+    return d
+
+def batch_eul_dist(a, b_set):
+    return np.sqrt(np.sum(np.square(b_set-a), axis=1))
+
+def read_iris():
+    #read iris data from iris.data, normalized to 0~1
+    with open('iris.data') as iris_f:
+        iris_data = iris_f.read().split('\n')
+    data = np.array([ [ float(line.split(',')[j]) for j in xrange(0,2) ] for line in iris_data])
+    cols = data.shape[1]
+    rows = data.shape[0]
+    min_arr = np.array([ [ min(data[:,c]) for c in xrange(cols) ] for r in xrange(rows) ])
+    max_arr = np.array([ [ max(data[:,c]) for c in xrange(cols) ] for r in xrange(rows) ])
+    return (data-min_arr)/(max_arr-min_arr)
+
+def check_covering(tree):
+    for i in xrange(len(tree.level_stack)-1, 0, -1):
+        for n in tree.level_stack[i]:
+            is_dist_valid = n.parent.self_chd is not n and n.dist_to_prt<np.power(2.0, tree.top_level-(i-1))
+            is_parent = n.parent.self_chd is n and n.dist_to_prt==0.0
+            assert is_dist_valid or is_parent
+
+def check_separation(tree):
+    for l in xrange(len(tree.level_stack)-1, 0, -1):
+        level = tree.level_stack[l]
+        for i in xrange(len(level)-1):
+            for j in xrange(i+1, len(level)):
+                assert eul_dist(level[i].val, level[j].val) > np.power(2.0, tree.top_level-l)
+
+def check_nesting(tree, data_sum):
+    sum_bottom_level = 0
+    for n in tree.level_stack[-1]:
+        sum_bottom_level += len(n.same_val_set) + 1
+    assert sum_bottom_level == data_sum
+    assert tree.size == data_sum
+
+def check_density(tree):
+    bottom_level = tree.level_stack[-1]
+    for level in tree.level_stack:
+        for n1 in level:
+            count = 0
+            for n2 in bottom_level:
+                if eul_dist(n1.val, n2.val) <= np.power(2.0, n1.level) :
+                    count += 1
+                    count += len(n2.same_val_set)
+            assert count == tree.estimate_density(n1)
+
 class CoverTreeTest(unittest.TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        #trees built once for all tests, tests changing a tree build their own
+        data = read_iris()
+
+        #bulk build a cover tree
+        cls.built_tree = DensityCoverTree.build(data, eul_dist, 0, batch_eul_dist)
+
+        #fit top level to data
+        cls.auto_tree = DensityCoverTree(eul_dist, None, batch_eul_dist)
+        for i in xrange(len(data)):
+            cls.auto_tree.insert(Node(val=data[i], index=i))
+        cls.auto_built_tree = DensityCoverTree.build(data, eul_dist, None, batch_eul_dist)
+        cls.other_trees = [cls.built_tree, cls.auto_tree, cls.auto_built_tree]
+
     def setUp(self):
 
-        #read iris data from iris.data
-        with open('iris.data') as iris_f:
-            iris_data = iris_f.read().split('\n')
-        self.data_sum = len(iris_data)
-        #normalize to 0~1
-        data = np.array([ [ float(line.split(',')[j]) for j in xrange(0,2) ] for line in iris_data])
-        cols = data.shape[1]
+        data = read_iris()
+        self.data_sum = len(data)
+        self.data = data
         rows = data.shape[0]
-        min_arr = np.array([ [ min(data[:,c]) for c in xrange(cols) ] for r in xrange(rows) ])
-        max_arr = np.array([ [ max(data[:,c]) for c in xrange(cols) ] for r in xrange(rows) ])
-        data = (data-min_arr)/(max_arr-min_arr)
         
         #insert to a cover tree
         self.cover_tree = DensityCoverTree(eul_dist, 0)
@@ -68,5 +135,351 @@ class CoverTreeTest(unittest.TestCase):
                 density = self.cover_tree.estimate_density(n1)
                 assert count == density
 
+    def test_other_trees(self):
+        #bulk built trees and trees fitting top level keep the invariants
+        for tree in self.other_trees:
+            check_covering(tree)
+            check_separation(tree)
+            check_nesting(tree, self.data_sum)
+            check_density(tree)
+
+    def test_auto_top_level(self):
+        for tree in [self.auto_tree, self.auto_built_tree]:
+            #root is not alone on the level below top level
+            assert len(tree.level_stack[1]) > 1
+            assert tree.root_node.level == tree.top_level
+
+        #nodes far from root grow the top level instead of being dropped
+        tree = DensityCoverTree(eul_dist, None)
+        for i, d in enumerate(self.data):
+            tree.insert(Node(val=d*np.power(2.0, i%7), index=i))
+        assert tree.size == self.data_sum
+        for n in tree.level_stack[-1]:
+            assert eul_dist(n.val, tree.root_node.val) <= np.power(2.0, tree.top_level)
+
+    def test_compact(self):
+        self.check_compact([self.cover_tree] + self.other_trees)
+
+    def check_compact(self, trees):
+        for tree in trees:
+            compact = CompactDensityCoverTree.from_tree(tree)
+            assert len(compact.level_stack) == len(tree.level_stack)
+            assert compact.size == tree.size
+            for l, level in enumerate(tree.level_stack):
+                compact_level = compact.level_stack[l]
+                densities = {}
+                for n in compact_level:
+                    densities[compact.indices[n[0]]] = compact.estimate_density(n)
+                assert len(densities) == len(level)
+                for n in level:
+                    assert densities[n.index] == tree.estimate_density(n)
+
+            labels = covertree_clustering(compact, 3)
+            assert len(labels) == self.data_sum
+            assert set(labels) == set([0, 1, 2])
+
+    def test_snapshot(self):
+        for tree in [self.cover_tree, self.built_tree]:
+            compact = CompactDensityCoverTree.from_tree(tree)
+            path = tempfile.mkdtemp()
+            try:
+                compact.save(path)
+                loaded = CompactDensityCoverTree.load(path, eul_dist, tree.batch_dist_calculator)
+                assert loaded.size == compact.size
+                assert len(loaded.level_stack) == len(compact.level_stack)
+                for level in compact.level_stack:
+                    for n in level:
+                        assert loaded.estimate_density(n) == compact.estimate_density(n)
+                assert (covertree_clustering(loaded, 3) == covertree_clustering(compact, 3)).all()
+                assert loaded.knn(self.data[0], 5) == compact.knn(self.data[0], 5)
+            finally:
+                shutil.rmtree(path)
+
+    def test_snapshot_vectorized(self):
+        # memory mapped values are read by the type checked vectorized calculators
+        compact = CompactDensityCoverTree.build(self.data, vectorized_dist_calculator, 0, vectorized_batch_dist_calculator)
+        labels = ClusteringSession(compact).cluster(3)
+        path = tempfile.mkdtemp()
+        try:
+            compact.save(path)
+            for batch_dist in [vectorized_batch_dist_calculator, None]:
+                loaded = CompactDensityCoverTree.load(path, vectorized_dist_calculator, batch_dist)
+                assert (ClusteringSession(loaded).cluster(3) == labels).all()
+                assert loaded.knn(self.data[0], 5) == compact.knn(self.data[0], 5)
+                assert loaded.to_tree(DensityCoverTree).knn(self.data[0], 5) == compact.knn(self.data[0], 5)
+        finally:
+            shutil.rmtree(path)
+
+    def test_dist_cache(self):
+        calls = []
+        def counting_dist(a, b):
+            calls.append(id(a))
+            return eul_dist(a, b)
+
+        tree = DensityCoverTree(counting_dist, 0)
+        for i, d in enumerate(self.data):
+            del calls[:]
+            tree.insert(Node(val=d, index=i))
+            assert len(calls) == len(set(calls))
+        assert tree.total_saved_dist_calls > 0
+
+        for n in tree.level_stack[-1]:
+            del calls[:]
+            tree.estimate_density(n)
+            assert len(calls) == len(set(calls))
+            assert tree.dist_cache is None
+
+    def test_batch_dist(self):
+        batch_tree = DensityCoverTree(eul_dist, 0, batch_eul_dist)
+        for i, d in enumerate(self.data):
+            batch_tree.insert(Node(val=d, index=i))
+
+        assert len(batch_tree.level_stack) == len(self.cover_tree.level_stack)
+        for l, level in enumerate(self.cover_tree.level_stack):
+            batch_level = batch_tree.level_stack[l]
+            assert [n.index for n in batch_level] == [n.index for n in level]
+            for i, n in enumerate(level):
+                assert batch_tree.estimate_density(batch_level[i]) == self.cover_tree.estimate_density(n)
+
+    def test_parallel_density(self):
+        for tree in [self.cover_tree, CompactDensityCoverTree.from_tree(self.built_tree)]:
+            for l in xrange(len(tree.level_stack)):
+                densities = [ tree.estimate_density(n) for n in tree.level_stack[l] ]
+                assert estimate_densities(tree, l, 3) == densities
+            labels = covertree_clustering(tree, 3)
+            assert (covertree_clustering(tree, 3, 2) == labels).all()
+
+    def test_session(self):
+        for tree in [self.cover_tree, CompactDensityCoverTree.from_tree(self.built_tree)]:
+            session = ClusteringSession(tree)
+            ks = range(1, 30)
+            labels = session.cluster_range(ks)
+            levels = set([ session._level_of(k) for k in ks ])
+            assert sorted(session.candidates.keys()) == sorted(levels)
+            for k in ks:
+                assert (labels[k] == covertree_clustering(tree, k)).all()
+                assert len(set(labels[k])) == k
+
+    def test_density_bounds(self):
+        for tree in [self.auto_built_tree, CompactDensityCoverTree.from_tree(self.auto_built_tree)]:
+            for level in tree.level_stack:
+                for n in level:
+                    density = tree.estimate_density(n)
+                    width = np.inf
+                    for depth in xrange(len(tree.level_stack)):
+                        lower, upper = tree.estimate_density_bounds(n, max_depth=depth)
+                        assert lower <= density <= upper
+                        assert upper - lower <= width
+                        width = upper - lower
+                    assert width == 0
+                    lower, upper = tree.estimate_density_bounds(n, max_error=0.1)
+                    assert lower <= density <= upper and upper - lower <= 0.1 * lower
+            level_i = len(tree.level_stack) / 2
+            bounds = estimate_density_bounds(tree, level_i, 1, 1)
+            assert estimate_density_bounds(tree, level_i, 2, 1) == bounds
+            session = ClusteringSession(tree, max_error=0.1)
+            labels = session.cluster(3)
+            assert len(set(labels)) == 3
+            for level_i, candidates in session.candidates.iteritems():
+                assert len(session.bounds[level_i]) == len(candidates)
+
+    def test_online(self):
+        half = self.data_sum / 2
+        tree = DensityCoverTree.build(self.data[:half], eul_dist, None, batch_eul_dist)
+        online = OnlineClustering(tree, 3, 0.2)
+        reclusters = 0
+        for i in xrange(half, self.data_sum):
+            centers = online.centers
+            label = online.insert(Node(val=self.data[i], index=i))
+            if online.centers is centers:
+                assert label == np.argmin(tree._dist_to_set(tree.index_nodes[i], centers))
+            else:
+                reclusters += 1
+            for c, density in enumerate(online.densities):
+                assert density == tree.estimate_density(online.centers[c])
+        assert 0 < reclusters < half
+        assert (online.labels() == assign_labels(tree, online.centers)).all()
+
+        for i in xrange(0, self.data_sum, 5):
+            assert online.remove(i)
+        assert not online.remove(0)
+        labels = online.labels()
+        assert (labels[::5] == -1).all()
+        assert (labels == assign_labels(tree, online.centers)).all()
+
+    def test_assign_labels(self):
+        trees = [self.cover_tree, self.built_tree, CompactDensityCoverTree.from_tree(self.cover_tree)]
+        for tree in trees + [CompactDensityCoverTree.from_tree(self.built_tree)]:
+            bottom_level = tree.level_stack[-1]
+            for k in [1, 3, 20, len(bottom_level)]:
+                centers = [ bottom_level[i] for i in np.random.RandomState(k).permutation(len(bottom_level))[:k] ]
+                labels = assign_labels(tree, centers)
+                for n in bottom_level:
+                    clus = np.argmin(tree._dist_to_set(n, centers))
+                    for index in tree._node_indices(n):
+                        assert labels[index] == clus
+
+    def test_to_labels(self):
+        assert list(_to_labels([2, 0], [1, 0], 4)) == [0, -1, 1, -1]
+        assert list(_to_labels([0, 5], [1, 0], 4)) == [1, -1, -1, -1, -1, 0]
+        assert list(_to_labels([], [], 2)) == [-1, -1]
+
+    def test_search(self):
+        queries = np.random.RandomState(0).rand(10, 2)
+        for tree in [self.cover_tree] + self.other_trees + [CompactDensityCoverTree.from_tree(self.cover_tree)]:
+            for q in queries:
+                dists = np.array([ eul_dist(q, d) for d in self.data ])
+                for k in [1, 5, 30]:
+                    indices, knn_dists = tree.knn(q, k)
+                    assert len(indices) == k
+                    assert np.allclose(knn_dists, np.sort(dists)[:k])
+                    assert np.allclose(dists[indices], knn_dists)
+                for radius in [0.05, 0.2]:
+                    indices, range_dists = tree.range_query(q, radius)
+                    assert sorted(indices) == list(np.flatnonzero(dists <= radius))
+                    assert np.allclose(dists[indices], range_dists)
+
+    def test_remove(self):
+        auto_built_tree = DensityCoverTree.build(self.data, eul_dist, None, batch_eul_dist)
+        for tree in [self.cover_tree, auto_built_tree]:
+            root_index = tree.root_node.index
+            removed = [root_index] + [ i for i in xrange(0, self.data_sum, 3) if i != root_index ]
+            for index in removed:
+                assert tree.remove(index)
+            assert not tree.remove(root_index)
+            values = {}
+            for index in xrange(self.data_sum):
+                if index not in removed:
+                    values[index] = self.data[index]
+            for index in removed[::2]:
+                assert not tree.update(index, self.data[index])
+                values[index] = self.data[index] + 0.01
+                tree.insert(Node(val=values[index], index=index))
+            for index in removed[::4]:
+                values[index] = self.data[index]
+                assert tree.update(index, values[index])
+            assert tree.size == len(values)
+
+            bottom_level = tree.level_stack[-1]
+            indices = []
+            for n in bottom_level:
+                indices.extend(tree._node_indices(n))
+                for index in tree._node_indices(n):
+                    assert eul_dist(n.val, values[index]) == 0.0
+            assert sorted(indices) == sorted(values.keys())
+            for l in xrange(len(tree.level_stack)-1, 0, -1):
+                level = tree.level_stack[l]
+                for i in xrange(len(level)):
+                    n = level[i]
+                    assert n.level == tree.top_level - l
+                    assert n.dist_to_prt <= np.power(2.0, n.level+1)
+                    for j in xrange(i+1, len(level)):
+                        assert eul_dist(n.val, level[j].val) > np.power(2.0, n.level)
+            # levels hold exactly the nodes of the tree
+            tree_levels = [ [] for level in tree.level_stack ]
+            visiting = [tree.root_node]
+            while 0 != len(visiting):
+                n = visiting.pop()
+                tree_levels[tree.top_level-n.level].append(id(n))
+                visiting.extend(n.children_set)
+            assert map(sorted, tree_levels) == [ sorted(map(id, l)) for l in tree.level_stack ]
+            for n in bottom_level:
+                count = 0
+                for index in values:
+                    if eul_dist(n.val, values[index]) <= np.power(2.0, n.level):
+                        count += 1
+                assert count == tree.estimate_density(n)
+
+            labels = covertree_clustering(tree, 3)
+            assert set(labels[values.keys()]) == set([0, 1, 2])
+
+    def test_des_sum(self):
+        #duplicates inserted after their values have been pushed down
+        tree = DensityCoverTree(eul_dist, None)
+        data = np.concatenate((self.data, self.data[::3]))
+        for i, d in enumerate(data):
+            tree.insert(Node(val=d, index=i))
+            if 0 == i % 50:
+                tree.estimate_density(tree.level_stack[-1][0])
+        tree._roll_up_des_sum()
+
+        def count(n):
+            if 0 == len(n.children_set):
+                return len(n.same_val_set) + 1
+            return sum([ count(chd) for chd in n.children_set ])
+        assert count(tree.root_node) == len(data)
+        for level in tree.level_stack:
+            for n in level:
+                assert n.des_sum == count(n) - 1 - len(n.same_val_set)
+
+    def test_remove_chd(self):
+        rng = np.random.RandomState(0)
+        parent = Node(val=np.zeros(2), level=1)
+        children = []
+        for i in xrange(300):
+            if 0 != len(children) and rng.rand() < 0.4:
+                chd = children.pop(rng.randint(len(children)))
+                parent.remove_chd(chd)
+            else:
+                chd = Node(val=rng.rand(2), parent=parent, dist_to_prt=1.0, level=0, index=i)
+                parent.children_set.append(chd)
+                children.append(chd)
+            assert sorted(map(id, parent.children_set)) == sorted(map(id, children))
+        self.assertRaises(Exception, parent.remove_chd, Node(val=np.zeros(2), level=0))
+
+    def test_random_build(self):
+        for seed in xrange(40):
+            for dim in [1, 2]:
+                data = np.random.RandomState(seed).rand(100, dim)
+                for top_level in [1, None]:
+                    tree = CoverTree.build(data, eul_dist, top_level, batch_eul_dist)
+                    assert tree.size == len(data)
+                    for l, level in enumerate(tree.level_stack):
+                        vals = np.array([ n.val for n in level ])
+                        # separation
+                        dists = np.sqrt(np.square(vals[:, None, :] - vals[None, :, :]).sum(axis=2))
+                        assert (dists[np.triu_indices(len(level), 1)] > np.power(2.0, tree.top_level-l)).all()
+                        # covering, inclusive
+                        if 0 != l:
+                            parent_vals = np.array([ n.parent.val for n in level ])
+                            assert (np.sqrt(np.square(vals - parent_vals).sum(axis=1)) <= np.power(2.0, tree.top_level-l+1)).all()
+
+    def test_bounded_dist(self):
+        tree = DensityCoverTree(bounded_eul_dist, 0)
+        for i, d in enumerate(self.data):
+            tree.insert(Node(val=d, index=i))
+        assert len(tree.level_stack) == len(self.cover_tree.level_stack)
+        for l, level in enumerate(tree.level_stack):
+            densities = dict([ (n.index, tree.estimate_density(n)) for n in level ])
+            for n in self.cover_tree.level_stack[l]:
+                assert densities[n.index] == self.cover_tree.estimate_density(n)
+            assert estimate_density_bounds(tree, l, 1, 1) == estimate_density_bounds(self.cover_tree, l, 1, 1)
+        check_covering(tree)
+        check_separation(tree)
+        self.check_compact([tree])
+
+    def test_sharded_build(self):
+        #shards grouped by dominant column, and shards split by distance
+        by_column = [ list(np.flatnonzero(self.data.argmax(axis=1) == c)) for c in xrange(2) ]
+        trees = [build_sharded(DensityCoverTree, self.data, eul_dist, 0, batch_eul_dist, shards=by_column, n_jobs=2),
+        build_sharded(DensityCoverTree, self.data, eul_dist, None, batch_eul_dist, n_jobs=3)]
+        for tree in trees:
+            #grafts and promotions attach within the inclusive bound of _filter
+            for level in tree.level_stack[1:]:
+                for n in level:
+                    assert n.dist_to_prt <= np.power(2.0, n.level+1)
+                    assert n.dist_to_prt == eul_dist(n.val, n.parent.val)
+                    assert (0.0 == n.dist_to_prt) == (n.parent.self_chd is n)
+        for tree in trees:
+            check_separation(tree)
+            check_nesting(tree, self.data_sum)
+            check_density(tree)
+            assert sorted(tree.index_nodes.keys()) == range(self.data_sum)
+            for index, n in tree.index_nodes.iteritems():
+                assert (n.val == self.data[index]).all()
+            labels = covertree_clustering(tree, 3)
+            assert len(labels) == self.data_sum
+            assert set(labels) == set([0, 1, 2])
+
 
 unittest.main()
\ No newline at end of file
@@ -3,6 +3,9 @@
 import sys
 sys.path.append(sys.path[0] + '/../')
 from dist.bottom_up_edit_dist import *
+from dist.dist_matrix import dist_matrix, condensed_dist_matrix, CondensedDistMatrix, neighbour_graph
+from covertree.compact_covertree import CompactCoverTree
+from scipy.spatial.distance import squareform
 import numpy as np
 from data_loader.data_loader import DataLoader
 import unittest
@@ -10,6 +13,20 @@ import random
 from config.load_config import Config
 import json
 import Queue
+import tempfile
+import shutil
+import os
+
+def random_trees(seed, count, alphabet, max_paths, max_depth):
+    #trees of random paths over an alphabet, labels repeat within and across trees
+    rand = random.Random(seed)
+    trees = []
+    for i in xrange(count):
+        t = BUEditTree('u%d' % i)
+        for j in xrange(rand.randint(1, max_paths)):
+            t.insert([ rand.choice(alphabet) for k in xrange(rand.randint(1, max_depth)) ])
+        trees.append(t)
+    return trees
 
 class EditDistTest(unittest.TestCase):
 
@@ -57,4 +74,157 @@ class EditDistTest(unittest.TestCase):
         assert base_tree.size-1  == d
         
 
+class EditTreeTest(unittest.TestCase):
+
+    def test_signatures(self):
+        paths = [['a', 'b', 'x'], ['a', 'b', 'y'], ['c', 'b', 'x'], ['c', 'b', 'y'], ['a', 'd', 'z']]
+        t1 = BUEditTree('u1')
+        for path in paths:
+            t1.insert(path)
+        # equal subtrees under different parents share a signature
+        a, c = t1.root.chd_set[0], t1.root.chd_set[1]
+        assert a.chd_set[0].signature == c.chd_set[0].signature
+        assert 2 == len(t1.signature_nodes[a.chd_set[0].signature])
+
+        # insertion order of an unordered tree does not matter
+        t2 = BUEditTree('u2')
+        for path in reversed(paths):
+            t2.insert(path)
+        assert 0 == bottomup_edit_dist_calculator(t1, t2)
+
+        # a leaf label differs: one substitution
+        t3 = BUEditTree('u3')
+        for path in paths[:-1] + [['a', 'd', 'w']]:
+            t3.insert(path)
+        assert 1 == bottomup_edit_dist_calculator(t1, t3)
+        # one more leaf under d: d is not mapped, d, z and the new leaf are edited
+        t3.insert(['a', 'd', 'z'])
+        assert bottomup_edit_dist_calculator(t1, t3) == bottomup_edit_dist_calculator(t3, t1)
+
+    def test_injective_mapping(self):
+        # both c1 of u1 were once mapped onto the single c1 of u2, giving 1
+        u1 = BUEditTree('u1')
+        u1.insert(['c0', 'c2', 'c1', 'b4'])
+        u1.insert(['c1', 'b13'])
+        u2 = BUEditTree('u2')
+        u2.insert(['c2', 'c1', 'b10'])
+        assert 4 == bottomup_edit_dist_calculator(u1, u2)
+        assert 4 == bottomup_edit_dist_calculator(u2, u1)
+
+    def test_leaves_paired_per_node(self):
+        # leaves are paired inside mapped nodes only, pooled labels gave 0 and 6
+        paths1 = [['p', 's', 'x'], ['p', 's', 'y'], ['q', 's', 'z'], ['q', 's', 'w']]
+        paths2 = [['p', 's', 'x'], ['p', 's', 'z'], ['q', 's', 'y'], ['q', 's', 'w']]
+        paths3 = [['r', 's', 'x'], ['r', 's', 'z']]
+        for compact in [False, True]:
+            trees = []
+            for i, paths in enumerate([paths1, paths2, paths3]):
+                t = BUEditTree('u%d' % i)
+                for path in paths:
+                    t.insert(path)
+                if compact:
+                    t.compact()
+                trees.append(t)
+            assert 2 == bottomup_edit_dist_calculator(trees[0], trees[1])
+            assert 2 == bottomup_edit_dist_calculator(trees[1], trees[0])
+            assert 7 == bottomup_edit_dist_calculator(trees[0], trees[2])
+            assert 7 == bottomup_edit_dist_calculator(trees[2], trees[0])
+
+    def test_compact(self):
+        paths = [['a', 'b', 'x'], ['a', 'b', 'y'], ['c', 'b', 'x'], ['c', 'd', 'y'], ['c', 'd', 'e', 'z']]
+        live = []
+        compacted = []
+        for i in xrange(len(paths)):
+            t1 = BUEditTree('u%d' % i)
+            t2 = BUEditTree('u%d' % i)
+            for path in paths[i:] + paths[:i/2]:
+                t1.insert(path)
+                t2.insert(path)
+            t2.compact()
+            live.append(t1)
+            compacted.append(t2)
+        for i in xrange(len(paths)):
+            assert compacted[i].compacted and 0 == len(compacted[i].root.chd_set)
+            for sig, labels, chd in compacted[i].nodes:
+                for label in labels or ():
+                    assert label_table.labels[label] is label
+            for j in xrange(len(paths)):
+                d = bottomup_edit_dist_calculator(live[i], live[j])
+                assert bottomup_edit_dist_calculator(compacted[i], compacted[j]) == d
+                assert bottomup_edit_dist_calculator(live[i], compacted[j]) == d
+        self.assertRaises(Exception, compacted[0].insert, ['a', 'b'])
+
+    def test_upper_bound(self):
+        trees = random_trees(0, 30, 'abcd', 12, 4)
+        for t in trees[::2]:
+            t.compact()
+        for t1 in trees:
+            for t2 in trees:
+                d = bottomup_edit_dist_calculator(t1, t2)
+                assert abs(t1.size - t2.size) <= d
+                for upper_bound in [0, 0.5, 1, 4, d-1, d, d+1]:
+                    bounded = bottomup_edit_dist_calculator(t1, t2, upper_bound)
+                    if d <= upper_bound:
+                        assert bounded == d
+                    else:
+                        assert upper_bound < bounded <= d
+        
+
+    def test_dist_matrix(self):
+        trees = random_trees(1, 23, 'abc', 8, 3)
+        expected = np.zeros((len(trees), len(trees)))
+        for i in xrange(len(trees)):
+            for j in xrange(len(trees)):
+                if i != j:
+                    expected[i, j] = bottomup_edit_dist_calculator(trees[i], trees[j])
+        kernel = lambda d: np.exp(-d)
+        path = tempfile.mkdtemp()
+        try:
+            for n_jobs in [1, 2]:
+                matrix = dist_matrix(trees, bottomup_edit_dist_calculator, block_size=5, n_jobs=n_jobs)
+                assert (matrix == expected).all()
+                matrix = dist_matrix(trees, bottomup_edit_dist_calculator, kernel, dtype=np.float32,
+                path=os.path.join(path, 'm%d' % n_jobs), block_size=5, n_jobs=n_jobs)
+                assert matrix.dtype == np.float32
+                assert np.allclose(matrix, kernel(expected))
+        finally:
+            shutil.rmtree(path)
+
+    def test_condensed_dist_matrix(self):
+        trees = random_trees(2, 19, 'abc', 8, 3)
+        square = dist_matrix(trees, bottomup_edit_dist_calculator)
+        path = tempfile.mkdtemp()
+        try:
+            for n_jobs in [1, 2]:
+                file_name = os.path.join(path, 'm%d.npy' % n_jobs)
+                matrix = condensed_dist_matrix(trees, bottomup_edit_dist_calculator, path=file_name,
+                block_size=4, n_jobs=n_jobs)
+                assert (matrix.condensed == squareform(square, checks=False)).all()
+                loaded = CondensedDistMatrix.load(file_name)
+                assert loaded.shape == square.shape
+                assert (loaded.to_square(block_size=3) == square).all()
+                assert (loaded.rows(5, 9) == square[5:9]).all()
+            kernel = lambda d: np.exp(-d)
+            matrix = condensed_dist_matrix(trees, bottomup_edit_dist_calculator, kernel, block_size=4)
+            assert np.allclose(matrix.to_square(), kernel(square))
+        finally:
+            shutil.rmtree(path)
+
+    def test_neighbour_graph(self):
+        trees = random_trees(3, 40, 'abcd', 6, 3)
+        square = dist_matrix(trees, bottomup_edit_dist_calculator)
+        np.fill_diagonal(square, np.inf)
+        tree = CompactCoverTree.build(trees, bottomup_edit_dist_calculator, None)
+        for tree, n_jobs in [(tree, 1), (tree, 2), (None, 1), (None, 2)]:
+            for radius in [0, 3]:
+                graph = neighbour_graph(trees, bottomup_edit_dist_calculator, radius=radius, tree=tree,
+                block_size=7, n_jobs=n_jobs).tocoo()
+                assert graph.nnz == (square <= radius).sum()
+                assert (square[graph.row, graph.col] == graph.data).all() and (graph.data <= radius).all()
+            graph = neighbour_graph(trees, bottomup_edit_dist_calculator, k=4, tree=tree,
+            block_size=7, n_jobs=n_jobs).tocoo()
+            assert graph.nnz == 4 * len(trees)
+            assert (square[graph.row, graph.col] == graph.data).all()
+            assert (graph.data <= np.sort(square, axis=1)[graph.row, 3]).all()
+
 unittest.main()
\ No newline at end of file
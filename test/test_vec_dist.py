@@ -22,4 +22,46 @@ class VectorizedUserDistTester(unittest.TestCase):
             d_2 = self.data[random_index]
             assert vectorized_dist_calculator(d_1, d_2) >=0 and vectorized_dist_calculator(d_1, d_2) <= np.sqrt(len(d_1))
 
+class CompiledPivotsTester(unittest.TestCase):
+
+    def test_compiled_pivots(self):
+        rand = random.Random(0)
+        paths = [ ['t%d' % (i%3)] + [ 'c%d' % rand.randint(0, 2) for k in xrange(rand.randint(0, 2)) ] for i in xrange(60) ]
+        pivots = {}
+        for path in paths:
+            pivots.setdefault(path[0], CateTree()).insert(path)
+        pivots = pivots.values()
+        compiled = CompiledPivots(pivots)
+        for i in xrange(20):
+            path_set = [ rand.choice(paths) for j in xrange(rand.randint(1, 10)) ] + [ ['t0', 'missing'] ]
+            similarities = compiled.similarities(path_set)
+            assert (similarities == np.array([ t.similarity(path_set) for t in pivots ])).all()
+            bus_cate_dict = {'b%d' % j: [path] for j, path in enumerate(path_set)}
+            for sigma in [0., 0.5, [0.1, 0.2, 0.3]]:
+                feature_arr = vectorized_convertor('u', bus_cate_dict, {'pivots': compiled, 'sigma': sigma})
+                s = np.array(sigma) if sigma != 0. else None
+                expected = similarities if s is None else np.exp(-np.power(similarities, 2)/(2.0*np.power(s, 2)))
+                assert np.allclose(feature_arr, expected)
+                assert (vectorized_convertor('u', bus_cate_dict, {'pivots': pivots, 'sigma': sigma}) == feature_arr).all()
+
+    def test_batch_vectorized_convertor(self):
+        rand = random.Random(1)
+        paths = [ ['t%d' % (i%4)] + [ 'c%d' % rand.randint(0, 2) for k in xrange(rand.randint(0, 2)) ] for i in xrange(80) ]
+        pivots = {}
+        for path in paths:
+            pivots.setdefault(path[0], CateTree()).insert(path)
+        pivots = pivots.values()
+        bus_cate_dict = dict([ ('b%d' % b, [ rand.choice(paths) for c in xrange(rand.randint(1, 3)) ]) for b in xrange(50) ])
+        user_bus_dict = dict([ ('u%d' % u, [ 'b%d' % rand.randint(0, 49) for b in xrange(rand.randint(0, 12)) ]) for u in xrange(70) ])
+        uids = sorted(user_bus_dict.keys())
+        for sigma in [0., 0.5, [0.1, 0.2, 0.3, 0.4]]:
+            kwargs = {'pivots': pivots, 'sigma': sigma}
+            expected = np.array([ vectorized_convertor(uid, dict([ (bid, bus_cate_dict[bid]) for bid in user_bus_dict[uid] ]), kwargs)
+            for uid in uids ])
+            for n_jobs in [1, 2]:
+                features = batch_vectorized_convertor(user_bus_dict, bus_cate_dict, CompiledPivots(pivots), uids,
+                sigma=sigma, chunk_size=16, n_jobs=n_jobs)
+                assert features.dtype == np.float32 and features.shape == (len(uids), len(pivots))
+                assert np.allclose(features, expected, rtol=1e-6)
+
 unittest.main()
\ No newline at end of file